@@ -0,0 +1,507 @@
+#! /usr/bin/env python3
+
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Analyze ZooKeeper Data
+
+Offline analysis of the snapshot and transaction log files of a ZooKeeper
+data directory: the largest subtrees and znodes, the sessions owning the
+most ephemeral znodes, and the sessions and paths writing the most.
+
+The files are memory-mapped and decoded in a single pass, keeping only
+fixed size top lists and counters, so that memory use does not grow with
+the size of the data tree or of the logs.
+
+"""
+
+import heapq
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from optparse import OptionParser
+
+
+__version__ = (0, 1, 0)
+
+VERSION_DIR = 'version-2'
+SNAPSHOT_MAGIC = 0x5A4B534E  # 'ZKSN'
+TXLOG_MAGIC = 0x5A4B4C47  # 'ZKLG'
+# The "/" path that ends the data tree in a snapshot.
+SNAPSHOT_END = b'\x00\x00\x00\x01/'
+# End of record marker following every transaction log entry.
+EOR = 0x42
+
+# Transaction types (ZooDefs.OpCode) written to the logs.
+TXN_TYPES = {
+    -11: 'closeSession',
+    -10: 'createSession',
+    -1: 'error',
+    1: 'create',
+    2: 'delete',
+    5: 'setData',
+    7: 'setACL',
+    13: 'check',
+    14: 'multi',
+    15: 'create2',
+    16: 'reconfig',
+    19: 'createContainer',
+    20: 'deleteContainer',
+    21: 'createTTL',
+}
+# Transactions starting with the path of the znode they change.
+PATH_TXNS = frozenset((1, 2, 5, 7, 13, 15, 19, 20, 21))
+# Transactions carrying the new data right after the path.
+DATA_TXNS = frozenset((1, 5, 15, 19, 21))
+MULTI = 14
+
+INT = struct.Struct('>i')
+LONG = struct.Struct('>q')
+TXN_HEADER = struct.Struct('>qiqqi')  # clientId, cxid, zxid, time, type
+STAT = struct.Struct('>qqqqiiiqq')  # StatPersisted
+
+
+class FormatError(Exception):
+    pass
+
+
+class _Reader(object):
+    """ Decoder of the jute binary encoding, over a memory-mapped file """
+
+    def __init__(self, buf, offset=0, end=None):
+        self.buf = buf
+        self.offset = offset
+        self.end = len(buf) if end is None else end
+
+    def unpack(self, fmt):
+        if self.offset + fmt.size > self.end:
+            raise FormatError('truncated at offset %d' % self.offset)
+        value = fmt.unpack_from(self.buf, self.offset)
+        self.offset += fmt.size
+        return value
+
+    def int(self):
+        return self.unpack(INT)[0]
+
+    def long(self):
+        return self.unpack(LONG)[0]
+
+    def byte(self):
+        if self.offset >= self.end:
+            raise FormatError('truncated at offset %d' % self.offset)
+        self.offset += 1
+        return self.buf[self.offset - 1]
+
+    def skip_buffer(self):
+        """ Skip a buffer, returning its offset and length """
+        length = self.int()
+        if length < 0:
+            return self.offset, 0
+        if self.offset + length > self.end:
+            raise FormatError('truncated at offset %d' % self.offset)
+        self.offset += length
+        return self.offset - length, length
+
+    def string(self):
+        start, length = self.skip_buffer()
+        return bytes(self.buf[start:start + length]).decode('utf-8',
+                                                            'replace')
+
+
+class _TopCounter(object):
+    """ Counters of at most CAPACITY keys, keeping the largest ones
+
+    When full, the half of the keys with the lowest counts is dropped, so
+    the counts of heavy hitters seen late are lower bounds.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}
+
+    def get(self, key, default):
+        counter = self.counters.get(key)
+        if counter is None:
+            if len(self.counters) >= self.capacity:
+                kept = heapq.nlargest(self.capacity // 2,
+                                      self.counters.items(),
+                                      key=lambda item: item[1][0])
+                self.counters = dict(kept)
+            counter = self.counters[key] = default
+        return counter
+
+    def top(self, n):
+        return heapq.nlargest(n, self.counters.items(),
+                              key=lambda item: item[1][0])
+
+
+def _prefix(path, depth):
+    """ The first DEPTH components of PATH """
+    return '/'.join(path.split('/')[:depth + 1]) or '/'
+
+
+def _is_under(path, parent):
+    return path.startswith(parent + '/') if parent else path != ''
+
+
+def _mapped(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise FormatError('%s is empty' % path)
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _list_files(directory, prefix):
+    """ The files of a kind in the version-2 subdirectory, by zxid """
+    directory = os.path.join(directory, VERSION_DIR)
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    files = []
+    for name in names:
+        if name.startswith(prefix):
+            try:
+                files.append((int(name[len(prefix):], 16),
+                              os.path.join(directory, name)))
+            except ValueError:
+                pass
+    return [path for _, path in sorted(files)]
+
+
+def newest_snapshot(data_dir):
+    """ The newest completely written snapshot of DATA_DIR, or None """
+    for path in reversed(_list_files(data_dir, 'snapshot.')):
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 2 * len(SNAPSHOT_END):
+                continue
+            f.seek(-len(SNAPSHOT_END), os.SEEK_END)
+            if f.read() == SNAPSHOT_END:
+                return path
+    return None
+
+
+def analyze_snapshot(path, top=10, depth=3, capacity=10000):
+    """ Report the sizes of the subtrees and the ephemeral owners """
+    m = _mapped(path)
+    try:
+        if m[:2] == b'\x1f\x8b':
+            raise FormatError('%s is compressed' % path)
+        r = _Reader(m)
+        if r.int() != SNAPSHOT_MAGIC:
+            raise FormatError('%s is not a snapshot' % path)
+        r.int()  # version
+        r.long()  # dbid
+
+        session_count = r.int()
+        sessions_offset = r.offset
+        r.offset += session_count * (LONG.size + INT.size)
+
+        acl_count = r.int()
+        for _ in range(acl_count):
+            r.long()
+            for _ in range(max(0, r.int())):
+                r.int()  # perms
+                r.skip_buffer()  # scheme
+                r.skip_buffer()  # id
+
+        nodes = data_bytes = ephemerals = 0
+        largest_nodes = []
+        largest_subtrees = []
+        owners = _TopCounter(capacity)
+        # Nodes come in depth first order: the stack holds the path,
+        # size and node count of the subtrees being summed up.
+        stack = []
+        root = None
+
+        def close(entry):
+            subtree, size, count = entry
+            if stack:
+                stack[-1][1] += size
+                stack[-1][2] += count
+            if 0 < subtree.count('/') <= depth:
+                item = (size, count, subtree)
+                if len(largest_subtrees) < top:
+                    heapq.heappush(largest_subtrees, item)
+                else:
+                    heapq.heappushpop(largest_subtrees, item)
+
+        while True:
+            node = r.string()
+            if node == '/':
+                break
+            _, length = r.skip_buffer()
+            r.long()  # acl
+            stat = r.unpack(STAT)
+            owner = stat[7]
+
+            nodes += 1
+            data_bytes += length
+            if owner:
+                ephemerals += 1
+                owners.get(owner, [0])[0] += 1
+            item = (length, node or '/')
+            if len(largest_nodes) < top:
+                heapq.heappush(largest_nodes, item)
+            else:
+                heapq.heappushpop(largest_nodes, item)
+
+            while stack and not _is_under(node, stack[-1][0]):
+                entry = stack.pop()
+                if not stack:
+                    root = entry
+                close(entry)
+            stack.append([node, len(node) + length, 1])
+
+        while stack:
+            entry = stack.pop()
+            if not stack:
+                root = entry
+            close(entry)
+
+        # Look up the session timeouts of the top owners only.
+        top_owners = [(owner, counter[0])
+                      for owner, counter in owners.top(top)]
+        wanted = {owner for owner, _ in top_owners}
+        timeouts = {}
+        r.offset = sessions_offset
+        for _ in range(session_count):
+            session, timeout = r.long(), r.int()
+            if session in wanted:
+                timeouts[session] = timeout
+    finally:
+        m.close()
+
+    return {
+        'file': path,
+        'sessions': session_count,
+        'acls': acl_count,
+        'nodes': nodes,
+        'data_bytes': data_bytes,
+        # Path and data bytes, like zk_approximate_data_size
+        'approximate_data_size': root[1] if root else 0,
+        'ephemerals': ephemerals,
+        'largest_subtrees': [
+            {'path': subtree, 'bytes': size, 'nodes': count}
+            for size, count, subtree in sorted(largest_subtrees,
+                                               reverse=True)],
+        'largest_nodes': [
+            {'path': node, 'data_bytes': length}
+            for length, node in sorted(largest_nodes, reverse=True)],
+        'ephemeral_owners': [
+            {'session': '0x%x' % owner, 'ephemerals': count,
+             'timeout': timeouts.get(owner),
+             'live': owner in timeouts}
+            for owner, count in top_owners],
+    }
+
+
+class TxnLogStats(object):
+    """ Write volume per session, path prefix and type over txn logs """
+
+    def __init__(self, top=10, depth=3, capacity=10000):
+        self.top = top
+        self.depth = depth
+        self.txns = 0
+        self.bytes = 0
+        self.first = self.last = None
+        self.first_zxid = self.last_zxid = None
+        self.types = {}
+        # count, bytes, first time, last time
+        self.sessions = _TopCounter(capacity)
+        # count, data bytes
+        self.paths = _TopCounter(capacity)
+        self.files = []
+
+    def add_file(self, path):
+        m = _mapped(path)
+        view = memoryview(m)
+        txns = 0
+        try:
+            r = _Reader(m)
+            if r.int() != TXLOG_MAGIC:
+                raise FormatError('%s is not a transaction log' % path)
+            r.int()  # version
+            r.long()  # dbid
+            while r.offset < r.end:
+                try:
+                    crc = r.long()
+                    start, length = r.skip_buffer()
+                    # The rest of a log is preallocated with zeros.
+                    if length == 0:
+                        break
+                    if zlib.adler32(view[start:start + length]) != crc:
+                        break
+                    if r.byte() != EOR:
+                        break
+                except FormatError:
+                    # Truncated by a crash or by a copy of a live log.
+                    break
+                self._add_txn(_Reader(m, start, start + length), length)
+                txns += 1
+        finally:
+            view.release()
+            m.close()
+        self.files.append({'file': path, 'txns': txns})
+
+    def _add_txn(self, r, length):
+        session, _, zxid, time, kind = r.unpack(TXN_HEADER)
+        self.txns += 1
+        self.bytes += length
+        if self.first is None:
+            self.first, self.first_zxid = time, zxid
+        self.last, self.last_zxid = time, zxid
+
+        counter = self.sessions.get(session, [0, 0, time, time])
+        counter[0] += 1
+        counter[1] += length
+        counter[3] = time
+
+        if kind == MULTI:
+            ops = []
+            for _ in range(max(0, r.int())):
+                op = r.int()
+                start, op_length = r.skip_buffer()
+                ops.append((op, _Reader(r.buf, start, start + op_length)))
+        else:
+            ops = [(kind, r)]
+        for op, op_reader in ops:
+            name = TXN_TYPES.get(op, str(op))
+            self.types[name] = self.types.get(name, 0) + 1
+            if op in PATH_TXNS:
+                try:
+                    node = op_reader.string()
+                    size = op_reader.skip_buffer()[1] \
+                        if op in DATA_TXNS else 0
+                except FormatError:
+                    continue
+                counter = self.paths.get(_prefix(node, self.depth), [0, 0])
+                counter[0] += 1
+                counter[1] += size
+
+    def report(self):
+        seconds = ((self.last - self.first) / 1000.0
+                   if self.txns > 1 else 0)
+
+        def rate(count, first, last):
+            span = (last - first) / 1000.0
+            return round(count / span, 3) if span > 0 else None
+
+        return {
+            'files': self.files,
+            'txns': self.txns,
+            'bytes': self.bytes,
+            'seconds': seconds,
+            'txns_per_second': (round(self.txns / seconds, 3)
+                                if seconds else None),
+            'first_zxid': ('0x%x' % self.first_zxid
+                           if self.first_zxid is not None else None),
+            'last_zxid': ('0x%x' % self.last_zxid
+                          if self.last_zxid is not None else None),
+            'types': self.types,
+            'top_sessions': [
+                {'session': '0x%x' % session, 'txns': count,
+                 'bytes': size,
+                 'txns_per_second': rate(count, first, last)}
+                for session, (count, size, first, last)
+                in self.sessions.top(self.top)],
+            'top_paths': [
+                {'path': prefix, 'txns': count, 'data_bytes': size}
+                for prefix, (count, size) in self.paths.top(self.top)],
+        }
+
+
+def main():
+    opts, args = parse_cli()
+
+    snapshot = opts.snapshot
+    if snapshot is None and opts.data_dir:
+        snapshot = newest_snapshot(opts.data_dir)
+    logs = args
+    if not logs and (opts.txlog_dir or opts.data_dir):
+        logs = _list_files(opts.txlog_dir or opts.data_dir, 'log.')
+
+    report = {}
+    try:
+        if snapshot:
+            report['snapshot'] = analyze_snapshot(
+                snapshot, opts.top, opts.depth, opts.capacity)
+        if logs:
+            stats = TxnLogStats(opts.top, opts.depth, opts.capacity)
+            for path in logs:
+                stats.add_file(path)
+            report['txlogs'] = stats.report()
+    except (FormatError, OSError) as e:
+        print('Unable to analyze the data: %s' % e, file=sys.stderr)
+        return 1
+
+    if not report:
+        print('No snapshot or transaction log found', file=sys.stderr)
+        return 1
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+
+def get_version():
+    return '.'.join(map(str, __version__))
+
+
+def parse_cli():
+    parser = OptionParser(usage='./analyze_zookeeper_data.py <options> '
+                                '[TXLOG...]',
+                          version=get_version())
+
+    parser.add_option('-d', '--data-dir', dest='data_dir',
+                      help='analyze the newest snapshot and the '
+                           'transaction logs of DATA_DIR')
+
+    parser.add_option('-l', '--txlog-dir', dest='txlog_dir',
+                      help='read the transaction logs from TXLOG_DIR '
+                           'rather than DATA_DIR')
+
+    parser.add_option('-s', '--snapshot', dest='snapshot',
+                      help='analyze the SNAPSHOT file')
+
+    parser.add_option('-n', '--top', dest='top', type='int', default=10,
+                      help='length of the reported top lists (default: 10)')
+
+    parser.add_option('--depth', dest='depth', type='int', default=3,
+                      help='deepest subtrees and path prefixes reported '
+                           '(default: 3)')
+
+    parser.add_option('--capacity', dest='capacity', type='int',
+                      default=10000,
+                      help='number of sessions and path prefixes counted '
+                           'at once; counts of the ones beyond it are '
+                           'approximate (default: 10000)')
+
+    opts, args = parser.parse_args()
+
+    if not (opts.data_dir or opts.txlog_dir or opts.snapshot or args):
+        parser.error('A data directory, a snapshot or transaction logs '
+                     'are mandatory')
+
+    return (opts, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,7 +18,7 @@
 """ Check Zookeeper Cluster
 
 Generic monitoring script that could be used with multiple platforms (Ganglia,
-Nagios, Cacti).
+Nagios, Cacti, Prometheus).
 
 It requires ZooKeeper 3.4.0 or greater. The script needs the 'mntr' 4letter
 word command (patch ZOOKEEPER-744) that was now commited to the trunk. The
@@ -29,19 +29,78 @@ Taken from https://github.com/andreisavu/zookeeper-monitoring/
 """
 
 import sys
+import fcntl
+import itertools
+import json
+import math
+import mmap
 import socket
 import logging
 import re
+import struct
 import subprocess
 import os
+import tempfile
+import threading
+import time
 
-from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from io import StringIO
+from socketserver import ThreadingMixIn
 from optparse import OptionParser, OptionGroup
 
 
 __version__ = (0, 1, 0)
 
+META_DIR = '/tmp/zk_check'
+
+
+def _parse_latency(value, result):
+    m = LATENCY.match(value)
+    if m is not None:
+        for key, value in zip(('zk_min_latency', 'zk_avg_latency',
+                               'zk_max_latency'), m.groups()):
+            result[key] = float(value) if '.' in value else int(value)
+
+
+def _int_field(key):
+    def parse(value, result):
+        try:
+            result[key] = int(value)
+        except ValueError:
+            pass
+    return parse
+
+
+def _str_field(key):
+    def parse(value, result):
+        result[key] = value
+    return parse
+
+
+LATENCY = re.compile(r'(\d+(?:\.\d+)?)/(\d+(?:\.\d+)?)/(\d+(?:\.\d+)?)')
+CONS_LINE = re.compile(r'\s*/(\S+?)\[(\d+)\]\((.*)\)\s*$')
+WCHS_SUMMARY = re.compile(r'(\d+) connections watching (\d+) paths')
+WCHS_TOTAL = re.compile(r'Total watches:\s*(\d+)')
+
+# 'srvr' (and 'stat') summary lines, by the text before the first colon
+SRVR_FIELDS = {
+    'Zookeeper version': _str_field('zk_version'),
+    'Latency min/avg/max': _parse_latency,
+    'Received': _int_field('zk_packets_received'),
+    'Sent': _int_field('zk_packets_sent'),
+    'Connections': _int_field('zk_num_alive_connections'),
+    'Outstanding': _int_field('zk_outstanding_requests'),
+    'Zxid': _str_field('zk_zxid'),
+    'Mode': _str_field('zk_server_state'),
+    'Node count': _int_field('zk_znode_count'),
+}
+
+# the 'srvr' fields kept from the 'stat' output
+STAT_FIELDS = dict((key, SRVR_FIELDS[key]) for key in (
+    'Zookeeper version', 'Latency min/avg/max', 'Received', 'Sent',
+    'Outstanding', 'Mode', 'Node count'))
+
 log = logging.getLogger()
 logging.basicConfig(level=logging.ERROR)
 
@@ -54,10 +113,16 @@ class NagiosHandler(object):
 
         group.add_option('-w', '--warning', dest='warning')
         group.add_option('-c', '--critical', dest='critical')
+        group.add_option('--checks', dest='checks',
+                         help='check several keys against the same sample: '
+                              'KEY:WARNING:CRITICAL[,KEY:WARNING:CRITICAL]')
 
         parser.add_option_group(group)
 
     def analyze(self, opts, cluster_stats):
+        if opts.checks is not None:
+            return self.analyze_multi(opts, cluster_stats)
+
         try:
             warning = int(opts.warning)
             critical = int(opts.critical)
@@ -72,19 +137,8 @@ class NagiosHandler(object):
                   file=sys.stderr)
             return 2
 
-        warning_state, critical_state, values = [], [], []
-        for host, stats in cluster_stats.items():
-            if opts.key in stats:
-
-                value = stats[opts.key]
-                values.append('%s=%s;%s;%s' % (host, value, warning, critical))
-
-                if warning >= value > critical or warning <= value < critical:
-                    warning_state.append(host)
-
-                elif ((warning < critical and critical <= value)
-                      or (warning > critical and critical >= value)):
-                    critical_state.append(host)
+        warning_state, critical_state, values = self._check(
+            cluster_stats, opts.key, warning, critical)
 
         values = ' '.join(values)
         if critical_state:
@@ -101,6 +155,69 @@ class NagiosHandler(object):
             print('Ok "%s"!|%s' % (opts.key, values))
             return 0
 
+    def analyze_multi(self, opts, cluster_stats):
+        """ Check every key of --checks and report the worst state """
+        try:
+            checks = []
+            for check in opts.checks.split(','):
+                key, warning, critical = check.strip().split(':')
+                checks.append((key, int(warning), int(critical)))
+
+        except ValueError:
+            print('Invalid value for "checks": %s' % opts.checks,
+                  file=sys.stderr)
+            return 2
+
+        warnings, criticals, values = [], [], []
+        for key, warning, critical in checks:
+            warning_state, critical_state, key_values = self._check(
+                cluster_stats, key, warning, critical, label=key)
+
+            values.extend(key_values)
+            if critical_state:
+                criticals.append('"%s" %s' % (
+                    key, ', '.join(critical_state)))
+            elif warning_state:
+                warnings.append('"%s" %s' % (key, ', '.join(warning_state)))
+
+        values = ' '.join(values)
+        if criticals:
+            print('Critical %s!|%s' % ('; '.join(criticals + warnings),
+                                       values))
+            return 2
+
+        elif warnings:
+            print('Warning %s!|%s' % ('; '.join(warnings), values))
+            return 1
+
+        else:
+            print('Ok %s!|%s' % (
+                  ', '.join('"%s"' % c[0] for c in checks), values))
+            return 0
+
+    def _check(self, cluster_stats, key, warning, critical, label=None):
+        """ Compare the value of a key on every host with the thresholds
+
+        Returns the hosts in warning state, the hosts in critical state and
+        the perfdata for every host reporting the key.
+        """
+        warning_state, critical_state, values = [], [], []
+        for host, stats in cluster_stats.items():
+            if key in stats:
+
+                value = stats[key]
+                name = host if label is None else '%s_%s' % (label, host)
+                values.append('%s=%s;%s;%s' % (name, value, warning, critical))
+
+                if warning >= value > critical or warning <= value < critical:
+                    warning_state.append(host)
+
+                elif ((warning < critical and critical <= value)
+                      or (warning > critical and critical >= value)):
+                    critical_state.append(host)
+
+        return warning_state, critical_state, values
+
 
 class CactiHandler(object):
 
@@ -174,70 +291,590 @@ class GangliaHandler(object):
                     pass
 
 
+class PrometheusHandler(object):
+
+    # mntr keys that only ever grow until the server stats are reset
+    COUNTERS = ('zk_packets_received', 'zk_packets_sent')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sample = None
+        self._sample_time = None
+
+    @classmethod
+    def register_options(cls, parser):
+        group = OptionGroup(parser, 'Prometheus specific options')
+
+        group.add_option('--listen', dest='listen',
+                         metavar='[ADDRESS:]PORT',
+                         help='serve the metrics over HTTP instead of '
+                              'printing them once')
+
+        parser.add_option_group(group)
+
+    def analyze(self, opts, cluster_stats):
+        if opts.listen is None:
+            sys.stdout.write(self.render(opts.servers, cluster_stats))
+            return 0
+
+        address, _, port = opts.listen.rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            print('Invalid value for "listen": %s' % opts.listen,
+                  file=sys.stderr)
+            return 1
+
+        self._sample, self._sample_time = cluster_stats, time.monotonic()
+        handler = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = handler.render(opts.servers,
+                                      handler.collect(opts)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+        server = _ThreadingHTTPServer((address, port), RequestHandler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def collect(self, opts):
+        """ Get a sample for a scrape
+
+        Scrapes arriving while a sample is being taken wait for it and
+        share it, and a sample younger than --cache-ttl is reused.
+        """
+        requested = time.monotonic()
+        with self._lock:
+            if (self._sample_time is None or
+                    self._sample_time < requested - opts.cache_ttl):
+                self._sample = get_cluster_stats(
+                    opts.servers, opts.timeout, opts.cache_ttl, opts.window)
+                self._sample_time = time.monotonic()
+
+            return self._sample
+
+    def render(self, servers, cluster_stats):
+        """ Render the stats in the Prometheus text exposition format """
+        metrics = {}
+
+        def add(name, kind, labels, value):
+            metrics.setdefault(name, (kind, []))[1].append((labels, value))
+
+        for host, port in servers:
+            server = '%s:%s' % (host, port)
+            add('zookeeper_up', 'gauge', {'server': server},
+                1 if server in cluster_stats else 0)
+
+        for server, stats in sorted(cluster_stats.items()):
+            for key, value in sorted(stats.items()):
+                labels = {'server': server}
+
+                if key == 'zk_version':
+                    labels['version'] = value
+                    add('zookeeper_info', 'gauge', labels, 1)
+
+                elif key == 'zk_server_state':
+                    labels['state'] = value
+                    add('zookeeper_server_state', 'gauge', labels, 1)
+
+                elif isinstance(value, (int, float)):
+                    name = 'zookeeper_' + re.sub(
+                        '[^a-zA-Z0-9_]', '_', key[3:]
+                        if key.startswith('zk_') else key)
+                    if key in self.COUNTERS:
+                        add(name + '_total', 'counter', labels, value)
+                    else:
+                        add(name, 'gauge', labels, value)
+
+        lines = []
+        for name, (kind, samples) in sorted(metrics.items()):
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                lines.append('%s{%s} %s' % (name, ','.join(
+                    '%s="%s"' % (k, self._escape(v))
+                    for k, v in sorted(labels.items())), value))
+
+        return '\n'.join(lines) + '\n'
+
+    def _escape(self, value):
+        return (str(value).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SampleHistory(object):
+    """ Fixed-size ring buffer of numeric samples in a memory-mapped file
+
+    The file holds a header, the names of up to `columns` keys, one column
+    of timestamps and one column of doubles per key, each `capacity`
+    entries long. The oldest sample is overwritten once the buffer is
+    full, so the file size never changes. Missing values are stored as
+    NaN. Keys that do not fit in the column table, or whose name is longer
+    than NAME_SIZE bytes, are not recorded.
+    """
+
+    MAGIC = b'ZKRB'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIIIII')
+    NAME_SIZE = 64
+    NAN = struct.pack('<d', float('nan'))
+
+    def __init__(self, path, capacity=1440, columns=128):
+        self._path = path
+        self._capacity = capacity
+        self._columns = columns
+        self._names_offset = self.HEADER.size
+        self._times_offset = self._names_offset + columns * self.NAME_SIZE
+        self._data_offset = self._times_offset + capacity * 8
+        self._size = self._data_offset + columns * capacity * 8
+
+    def append(self, timestamp, stats):
+        """ Record the numeric values of a sample """
+        with self._open() as (buf, header):
+            count, head = header
+            names = self._read_names(buf)
+
+            values = {}
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    if key not in names and len(names) < self._columns:
+                        encoded = key.encode()
+                        if len(encoded) > self.NAME_SIZE:
+                            # a cut name would never match the key again
+                            continue
+                        struct.pack_into(
+                            '%ds' % self.NAME_SIZE, buf, self._names_offset +
+                            len(names) * self.NAME_SIZE, encoded)
+                        names[key] = len(names)
+                        # earlier samples did not have this key
+                        start = self._cell(names[key], 0)
+                        buf[start:start + self._capacity * 8] = \
+                            self.NAN * self._capacity
+                    if key in names:
+                        values[names[key]] = float(value)
+
+            struct.pack_into('<d', buf, self._times_offset + head * 8,
+                             timestamp)
+            for column in range(len(names)):
+                struct.pack_into('<d', buf, self._cell(column, head),
+                                 values.get(column, float('nan')))
+
+            self._write_header(buf, min(count + 1, self._capacity),
+                               (head + 1) % self._capacity)
+
+    def summarize(self, window, now=None):
+        """ Return min, max, avg and slope per key over the last `window` s
+
+        The slope is the least-squares trend of the values, per second.
+        Only the samples inside the window are read.
+        """
+        if now is None:
+            now = time.time()
+
+        with self._open() as (buf, header):
+            count, head = header
+            names = self._read_names(buf)
+
+            # walk back from the newest sample until the window is covered
+            indexes = []
+            for i in range(count):
+                index = (head - 1 - i) % self._capacity
+                (timestamp,) = struct.unpack_from(
+                    '<d', buf, self._times_offset + index * 8)
+                if timestamp < now - window:
+                    break
+                indexes.append((index, timestamp))
+
+            result = {}
+            for key, column in names.items():
+                points = []
+                for index, timestamp in indexes:
+                    (value,) = struct.unpack_from(
+                        '<d', buf, self._cell(column, index))
+                    if not math.isnan(value):
+                        points.append((timestamp, value))
+
+                if points:
+                    result[key] = self._describe(points)
+
+            return result
+
+    def _describe(self, points):
+        values = [v for _, v in points]
+        n = len(points)
+        mean_t = sum(t for t, _ in points) / n
+        mean_v = sum(values) / n
+        var_t = sum((t - mean_t) ** 2 for t, _ in points)
+        slope = 0.0
+        if var_t > 0:
+            slope = sum((t - mean_t) * (v - mean_v)
+                        for t, v in points) / var_t
+
+        return {'min': min(values), 'max': max(values),
+                'avg': round(mean_v, 3), 'slope': round(slope, 6)}
+
+    def _cell(self, column, index):
+        return self._data_offset + (column * self._capacity + index) * 8
+
+    def _read_names(self, buf):
+        names = {}
+        for column in range(self._columns):
+            offset = self._names_offset + column * self.NAME_SIZE
+            name = buf[offset:offset + self.NAME_SIZE].rstrip(b'\0')
+            if not name:
+                break
+            names[name.decode()] = column
+        return names
+
+    def _write_header(self, buf, count, head):
+        self.HEADER.pack_into(buf, 0, self.MAGIC, self.VERSION,
+                              self._capacity, self._columns, count, head)
+
+    def _open(self):
+        return _MappedFile(self)
+
+
+class _MappedFile(object):
+    """ Locked, memory-mapped access to a SampleHistory file
+
+    A file with another layout is reinitialized.
+    """
+
+    def __init__(self, history):
+        self._history = history
+
+    def __enter__(self):
+        history = self._history
+        fd = os.open(history._path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._file = os.fdopen(fd, 'r+b')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+
+        fresh = os.fstat(fd).st_size != history._size
+        if fresh:
+            self._file.truncate(0)
+            self._file.truncate(history._size)
+
+        self._buf = mmap.mmap(fd, history._size)
+        header = history.HEADER.unpack_from(self._buf, 0)
+        if fresh or header[:4] != (history.MAGIC, history.VERSION,
+                                   history._capacity, history._columns):
+            self._buf[:] = bytes(history._size)
+            history._write_header(self._buf, 0, 0)
+            header = history.HEADER.unpack_from(self._buf, 0)
+
+        return self._buf, header[4:]
+
+    def __exit__(self, *exc):
+        self._buf.close()
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
 class ZooKeeperServer(object):
 
+    # size of the buffer responses are received into
+    RECV_SIZE = 64 * 1024
+
+    # counters that are reported as per-second rates between two samples
+    RATE_KEYS = ('zk_packets_received', 'zk_packets_sent')
+
     def __init__(self, host='localhost', port='2181', timeout=1,
-                 meta_file='/tmp/zk_check/meta'):
+                 meta_file=None, cache_ttl=0, window=0, persist=True):
+        """ With `persist` unset, nothing is read from or written to disk:
+        samples are neither cached nor recorded, and have no rates or
+        trends.
+        """
         self._address = (host, int(port))
         self._timeout = timeout
-        self._last_reset = datetime.utcnow()
+        self._persist = persist
+        if meta_file is None:
+            meta_file = os.path.join(META_DIR, '%s_%s.meta' % self._address)
         self._meta_path = meta_file
+        self._cache_ttl = cache_ttl
+        self._cache_path = os.path.join(os.path.dirname(meta_file),
+                                        '%s_%s.cache' % self._address)
+        self._history = SampleHistory(os.path.join(
+            os.path.dirname(meta_file), '%s_%s.history' % self._address))
+        self._window = window
+
+        if persist:
+            try:
+                os.makedirs(os.path.dirname(meta_file), exist_ok=True)
+            except OSError as e:
+                logging.warning('unable to create %s: %s' % (
+                    os.path.dirname(meta_file), e))
 
-        os.makedirs(os.path.dirname(meta_file), exist_ok=True)
+    def get_stats(self):
+        """ Get ZooKeeper server stats as a map
 
-        with open(meta_file, 'a+') as f:
-            f.seek(0)
-            buf = f.read().strip()
-            if len(buf) > 0:
-                try:
-                    self._last_reset = datetime.utcfromtimestamp(float(buf))
-                except ValueError:
-                    f.seek(0)
-                    f.truncate()
-                    f.write(str(self._last_reset.timestamp()))
-            else:
-                f.write(str(self._last_reset.timestamp()))
+        When a cache TTL is set, a sample younger than the TTL is read back
+        from the cache file instead of querying the server. The cache is
+        guarded by a lock file so that concurrent runs share one sample.
+        """
+        if self._cache_ttl <= 0 or not self._persist:
+            return self._fetch_stats()
 
-    def get_stats(self):
-        """ Get ZooKeeper server stats as a map """
-        data = self._send_cmd('mntr')
-        if data:
-            return self._parse(data)
+        try:
+            lock = open(self._cache_path + '.lock', 'a')
+        except OSError as e:
+            # a local file problem must not hide the server
+            logging.warning('unable to use the sample cache: %s' % e)
+            return self._fetch_stats()
+
+        with lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                stats = self._read_cache()
+                if stats is None:
+                    stats = self._fetch_stats()
+                    self._write_cache(stats)
+                return stats
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_cache(self):
+        """ Return the cached stats, or None if missing or expired """
+        cached = self._read_sample(self._cache_path)
+        if cached is not None:
+            age = time.time() - cached['time']
+            if 0 <= age < self._cache_ttl:
+                return cached['stats']
+        return None
+
+    def _write_cache(self, stats):
+        """ Atomically replace the cache file with a new sample """
+        try:
+            self._write_sample(self._cache_path, time.time(), stats)
+        except OSError as e:
+            logging.warning('unable to write %s: %s' % (self._cache_path, e))
+
+    def _read_sample(self, path):
+        try:
+            with open(path) as f:
+                sample = json.load(f)
+            if isinstance(sample['time'], (int, float)) and \
+                    isinstance(sample['stats'], dict):
+                return sample
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def _write_sample(self, path, timestamp, stats):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'time': timestamp, 'stats': stats}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def _fetch_stats(self):
+        """ Query the server for a new sample """
+        lines = self._send_cmd_lines('mntr')
+        first = next(lines, None)
+        if first is not None:
+            stats = self._parse(itertools.chain([first], lines))
         else:
-            data = self._send_cmd('stat')
-            return self._parse_stat(data)
+            stats = self._parse_stat(
+                self._send_cmd_lines('stat', skip=b'Clients:\n'))
+
+        if not self._persist:
+            return stats
+
+        stats = self._add_rates(stats)
+        return self._add_trends(stats)
+
+    def _add_rates(self, stats):
+        """ Add rates computed against the previous sample
+
+        The previous sample is kept in the meta file. For every counter in
+        RATE_KEYS a '<key>_rate' key holds its per-second rate, and
+        'zk_avg_latency_window' holds the average latency of the requests
+        received since the previous sample. Nothing is added when the
+        counters went backwards (server restart or reset).
+        """
+        now = time.time()
+        previous = self._read_sample(self._meta_path)
+        try:
+            self._write_sample(self._meta_path, now, stats)
+        except OSError as e:
+            logging.warning('unable to write %s: %s' % (self._meta_path, e))
+
+        if previous is None or now <= previous['time']:
+            return stats
+
+        elapsed = now - previous['time']
+        old = previous['stats']
+
+        def delta(key):
+            try:
+                value = stats[key] - old[key]
+            except (KeyError, TypeError):
+                return None
+            return value if value >= 0 else None
+
+        for key in self.RATE_KEYS:
+            value = delta(key)
+            if value is not None:
+                stats[key + '_rate'] = round(value / elapsed, 3)
+
+        # the server reports the average latency since its stats were
+        # reset, so weight both averages by the requests they cover
+        received = delta('zk_packets_received')
+        if received:
+            try:
+                latency = (
+                    stats['zk_avg_latency'] * stats['zk_packets_received'] -
+                    old['zk_avg_latency'] * old['zk_packets_received'])
+                stats['zk_avg_latency_window'] = round(
+                    max(latency, 0) / received, 3)
+            except (KeyError, TypeError):
+                pass
+
+        return stats
+
+    def _add_trends(self, stats):
+        """ Record the sample in the history and add the window summaries
+
+        When a window is set, every numeric key gets '<key>_min',
+        '<key>_max', '<key>_avg' and '<key>_slope' keys computed over the
+        samples of the last `window` seconds.
+        """
+        try:
+            self._history.append(time.time(), stats)
+            if self._window <= 0:
+                return stats
+
+            summary = self._history.summarize(self._window)
+        except OSError as e:
+            logging.warning('unable to use the sample history: %s' % e)
+            return stats
+
+        for key, values in summary.items():
+            if key in stats:
+                for name, value in values.items():
+                    stats['%s_%s' % (key, name)] = value
+
+        return stats
 
     def _create_socket(self):
         return socket.socket()
 
     def _send_cmd(self, cmd):
-        """ Send a 4letter word command to the server """
-        s = self._create_socket()
-        s.settimeout(self._timeout)
-
-        s.connect(self._address)
-        s.send(cmd.encode())
-
-        data = s.recv(2048)
-        s.close()
+        """ Send a 4letter word command to the server
+
+        The whole response is read, up to the point where the server
+        closes the connection.
+        """
+        return b''.join(self._recv_chunks(cmd))
+
+    def _send_cmd_lines(self, cmd, skip=None):
+        """ Send a 4letter word command and yield the response line by line
+
+        Only the line being assembled is held in memory, so responses of
+        any size are handled. The connection is closed once the response
+        is exhausted or the generator is closed.
+
+        With `skip`, the block starting with that line (given as bytes,
+        newline included) and ending with an empty line is dropped as it
+        is received, without being split or decoded.
+        """
+        pending = b''
+        skipping = False
+        for chunk in self._recv_chunks(cmd):
+            pending += chunk
+            # while skipping, pending[start - 1] ended the previous line
+            start = 1 if skipping else 0
+            while True:
+                if skipping:
+                    end = pending.find(b'\n\n', start - 1)
+                    if end < 0:
+                        start = len(pending)
+                        break
+                    skipping = False
+                    start = end + 2
+                    continue
 
-        return data
+                end = pending.find(b'\n', start)
+                if end < 0:
+                    break
+                line = pending[start:end + 1]
+                start = end + 1
+                if line == skip:
+                    skipping = True
+                    continue
+                yield line.decode('utf-8', 'replace')
+            pending = pending[start - 1 if skipping else start:]
 
-    def _reset_stats(self):
-        """ Resets server statistics """
-        self._send_cmd('srst')
+        if pending and not skipping:
+            yield pending.decode('utf-8', 'replace')
 
-        with open(self._meta_path, 'w') as f:
-            f.seek(0)
-            f.truncate()
-            f.write(str(datetime.utcnow().timestamp()))
+    def _recv_chunks(self, cmd):
+        """ Yield the response of a command as it is received """
+        s = self._create_socket()
+        try:
+            s.settimeout(self._timeout)
+
+            s.connect(self._address)
+            s.sendall(cmd.encode())
+
+            buf = bytearray(self.RECV_SIZE)
+            view = memoryview(buf)
+            while True:
+                size = s.recv_into(buf)
+                if not size:
+                    break
+                yield bytes(view[:size])
+        finally:
+            s.close()
+
+    def get_server_info(self):
+        """ Get the server summary reported by 'srvr' as a map """
+        return self._parse_srvr(self._send_cmd_lines('srvr'))
+
+    def get_connections(self):
+        """ Yield a map for each client connection reported by 'cons' """
+        return self._parse_cons(self._send_cmd_lines('cons'))
+
+    def get_watch_summary(self):
+        """ Get the watch counts reported by 'wchs' as a map """
+        return self._parse_wchs(self._send_cmd_lines('wchs'))
+
+    def get_conf(self):
+        """ Get the server configuration reported by 'conf' as a map """
+        return self._parse_conf(self._send_cmd_lines('conf'))
+
+    def _lines(self, data):
+        """ Iterate over a response given as bytes or as lines """
+        if isinstance(data, (bytes, bytearray)):
+            return iter(StringIO(data.decode('utf-8')))
+        return iter(data)
 
     def _parse(self, data):
         """ Parse the output from the 'mntr' 4letter word command """
-        h = StringIO(data.decode('utf-8'))
-
         result = {}
-        for line in h.readlines():
+        for line in self._lines(data):
             try:
                 key, value = self._parse_line(line)
                 result[key] = value
@@ -246,56 +883,108 @@ class ZooKeeperServer(object):
 
         return result
 
-    def _parse_stat(self, data):
-        """ Parse the output from the 'stat' 4letter word command """
-        h = StringIO(data.decode('utf-8'))
-
+    def _parse_srvr(self, data):
+        """ Parse the output from the 'srvr' 4letter word command """
         result = {}
+        for line in self._lines(data):
+            key, _, value = line.partition(':')
+            parse = SRVR_FIELDS.get(key)
+            if parse is not None:
+                parse(value.strip(), result)
 
-        version = h.readline()
-        if version:
-            result['zk_version'] = version[version.index(':')+1:].strip()
+        return result
 
-        # skip all lines until we find the empty one
-        while h.readline().strip():
-            pass
+    def _parse_cons(self, data):
+        """ Parse the output from the 'cons' 4letter word command
 
-        for line in h.readlines():
-            m = re.match('Latency min/avg/max: (\d+)/(\d+)/(\d+)', line)
-            if m is not None:
-                result['zk_min_latency'] = int(m.group(1))
-                result['zk_avg_latency'] = int(m.group(2))
-                result['zk_max_latency'] = int(m.group(3))
+        Connections are yielded one at a time, so that the response of a
+        server with many clients does not have to be held in memory.
+        """
+        for line in self._lines(data):
+            m = CONS_LINE.match(line)
+            if m is None:
                 continue
 
-            m = re.match('Received: (\d+)', line)
-            if m is not None:
-                result['zk_packets_received'] = int(m.group(1))
-                continue
+            connection = {'address': m.group(1), 'interest': int(m.group(2))}
+            for field in m.group(3).split(','):
+                key, _, value = field.partition('=')
+                try:
+                    value = int(value, 16) if value.startswith('0x') \
+                        else int(value)
+                except ValueError:
+                    pass
+                connection[key] = value
 
-            m = re.match('Sent: (\d+)', line)
-            if m is not None:
-                result['zk_packets_sent'] = int(m.group(1))
-                continue
+            yield connection
 
-            m = re.match('Outstanding: (\d+)', line)
+    def _parse_wchs(self, data):
+        """ Parse the output from the 'wchs' 4letter word command """
+        result = {}
+        for line in self._lines(data):
+            m = WCHS_SUMMARY.match(line)
             if m is not None:
-                result['zk_outstanding_requests'] = int(m.group(1))
+                result['zk_watch_connections'] = int(m.group(1))
+                result['zk_watch_paths'] = int(m.group(2))
                 continue
 
-            m = re.match('Mode: (.*)', line)
+            m = WCHS_TOTAL.match(line)
             if m is not None:
-                result['zk_server_state'] = m.group(1)
+                result['zk_watch_count'] = int(m.group(1))
+
+        return result
+
+    def _parse_conf(self, data):
+        """ Parse the output from the 'conf' 4letter word command """
+        result = {}
+        for line in self._lines(data):
+            key, sep, value = line.strip().partition('=')
+            if not sep or not key:
                 continue
 
-            m = re.match('Node count: (\d+)', line)
-            if m is not None:
-                result['zk_znode_count'] = int(m.group(1))
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+            result[key] = value
+
+        return result
+
+    def _parse_stat(self, data):
+        """ Parse the output from the 'stat' 4letter word command
+
+        Each line is dispatched on the text before its first colon, the
+        client connection list is skipped without looking into it, and
+        reading stops as soon as all the summary keys have been seen.
+
+        Given bytes, the client list is cut out with two searches before
+        anything is decoded, so its size barely matters.
+        """
+        result = {}
+        wanted = len(STAT_FIELDS)
+        seen = 0
+
+        if isinstance(data, (bytes, bytearray)):
+            start = data.find(b'Clients:\n')
+            if start >= 0:
+                end = data.find(b'\n\n', start)
+                data = data[:start] + (data[end + 2:] if end >= 0 else b'')
+
+        h = self._lines(data)
+        for line in h:
+            key, _, value = line.partition(':')
+            parse = STAT_FIELDS.get(key)
+            if parse is None:
+                if key == 'Clients':
+                    # skip the connections, up to the empty line
+                    for line in h:
+                        if not line.strip():
+                            break
                 continue
 
-        td = datetime.utcnow() - self._last_reset
-        if td.seconds // 60 >= 60:  # 60 mins
-            self._reset_stats()
+            parse(value.strip(), result)
+            seen += 1
+            if seen == wanted:
+                break
 
         return result
 
@@ -311,7 +1000,10 @@ class ZooKeeperServer(object):
         try:
             value = int(value)
         except (TypeError, ValueError):
-            pass
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                pass
 
         return key, value
 
@@ -319,7 +1011,8 @@ class ZooKeeperServer(object):
 def main():
     opts, args = parse_cli()
 
-    cluster_stats = get_cluster_stats(opts.servers)
+    cluster_stats = get_cluster_stats(opts.servers, opts.timeout,
+                                      opts.cache_ttl, opts.window)
     if opts.output is None:
         dump_stats(cluster_stats)
         return 0
@@ -342,7 +1035,7 @@ def create_handler(name):
 
 def get_all_handlers():
     """ Get a list containing all the platform specific analyzers """
-    return [NagiosHandler, CactiHandler, GangliaHandler]
+    return [NagiosHandler, CactiHandler, GangliaHandler, PrometheusHandler]
 
 
 def dump_stats(cluster_stats):
@@ -355,25 +1048,59 @@ def dump_stats(cluster_stats):
         print()
 
 
-def get_cluster_stats(servers):
-    """ Get stats for all the servers in the cluster """
+def get_cluster_stats(servers, timeout=None, cache_ttl=0, window=0):
+    """ Get stats for all the servers in the cluster
+
+    All the servers are queried concurrently. If `timeout` is given, the
+    servers that did not answer when it expires are left out, the same
+    way as the servers that could not be reached at all. `cache_ttl` and
+    `window` are passed on to ZooKeeperServer.
+    """
     stats = {}
-    for host, port in servers:
+    lock = threading.Lock()
+
+    def query(host, port):
         try:
-            zk = ZooKeeperServer(host, port)
-            stats["%s:%s" % (host, port)] = zk.get_stats()
+            zk = ZooKeeperServer(host, port, cache_ttl=cache_ttl,
+                                 window=window)
+            result = zk.get_stats()
 
         except socket.error:
             # ignore because the cluster can still work even
-            # if some servers fail completely
+            # if some servers fail completely (errors on the local
+            # files are handled by ZooKeeperServer, and never get here)
 
             # this error should be also visible in a variable
             # exposed by the server in the statistics
 
             logging.info('unable to connect to server '
                          '"%s" on port "%s"' % (host, port))
+            return
 
-    return stats
+        with lock:
+            stats["%s:%s" % (host, port)] = result
+
+    threads = []
+    for host, port in servers:
+        t = threading.Thread(target=query, args=(host, port))
+        t.daemon = True
+        t.start()
+        threads.append((host, port, t))
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for host, port, t in threads:
+        if deadline is None:
+            t.join()
+        else:
+            t.join(max(0, deadline - time.monotonic()))
+
+        if t.is_alive():
+            logging.info('timeout while querying server '
+                         '"%s" on port "%s"' % (host, port))
+
+    # take a copy so late answers do not change the result
+    with lock:
+        return dict(stats)
 
 
 def get_version():
@@ -388,11 +1115,28 @@ def parse_cli():
                       help='a list of SERVERS', metavar='SERVERS')
 
     parser.add_option('-o', '--output', dest='output',
-                      help='output HANDLER: nagios, ganglia, cacti',
+                      help='output HANDLER: nagios, ganglia, cacti, '
+                           'prometheus',
                       metavar='HANDLER')
 
     parser.add_option('-k', '--key', dest='key')
 
+    parser.add_option('-t', '--timeout', dest='timeout', type='float',
+                      default=2.0,
+                      help='overall deadline in seconds for querying '
+                           'all the servers (default: 2)')
+
+    parser.add_option('--cache-ttl', dest='cache_ttl', type='float',
+                      default=0,
+                      help='reuse a sample taken less than CACHE_TTL '
+                           'seconds ago by another run (default: 0, '
+                           'disabled)')
+
+    parser.add_option('--window', dest='window', type='float', default=0,
+                      help='add the min, max, average and slope of every '
+                           'key over the last WINDOW seconds of recorded '
+                           'samples (default: 0, disabled)')
+
     for handler in get_all_handlers():
         handler.register_options(parser)
 
@@ -13,14 +13,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import grp
+import hashlib
+import importlib.util
+import json
 import os
+import pwd
+import re
+import socket
 import subprocess
+import tempfile
+import time
 
 from charmhelpers.core import host, hookenv, unitdata
 from charmhelpers.core.templating import render
 
 from charms.reactive.relations import RelationBase
 
+from charms import apt
+from charms.layer.zookeeper_profiling import timer
+from charms.layer.zookeeper_storage import (
+    disk_usage_percent, fsync_benchmark, latest_snapshot_size, purge_plan,
+    throttled_unlink)
+from charms.leadership import leader_get
+
 
 ZK_PORT = 2181
 ZK_REST_PORT = 9998
@@ -28,16 +45,423 @@ APP_NAME = 'zookeeper'
 APP_COMMON = '/etc/{}/conf'.format(APP_NAME)
 SERVICE_NAME = '{name}.service'.format(name=APP_NAME)
 APP_DATADIR = '/var/lib/{}'.format(APP_NAME)
+ZK_MODES = ('leader', 'follower', 'standalone', 'observer')
+# First release with dynamic reconfiguration (the 'reconfig' command).
+RECONFIG_VERSION = (3, 5, 0)
+GC_LOG = '/var/log/{}/gc.log'.format(APP_NAME)
+# Bounds of the automatic heap size, in MB. Above 31GB the JVM loses
+# compressed object pointers.
+MIN_HEAP_MB = 512
+MAX_HEAP_MB = 31 * 1024
+# Rate, in bytes per second, at which a follower is assumed to receive
+# and load the snapshot of the leader when it syncs.
+SYNC_BYTES_PER_SEC = 10 * 1024 * 1024
+MIN_INIT_LIMIT = 10
+# Connections allowed to each client address, per related client unit.
+CLIENT_CNXNS_PER_UNIT = 10
+MIN_MAX_CLIENT_CNXNS = 60
+# Values the server runs with for the "auto" tunables. They are only
+# derived again in a rolling restart.
+AUTO_TUNABLES_KEY = 'zookeeper.auto_tunables'
+# Heap size, in MB, the server runs with for an "auto" heap_size; also
+# only derived again in a rolling restart.
+AUTO_HEAP_KEY = 'zookeeper.auto_heap_mb'
+# First Java release without the CMS collector.
+NO_CMS_JAVA_VERSION = 14
+# Last fsync benchmark of the transaction log storage, and the p99 above
+# which the storage is reported as slow. Every write waits for an fsync
+# of the log on a majority of the ensemble.
+FSYNC_KEY = 'zookeeper.storage.fsync'
+FSYNC_WARN_MS = 20
+# Time of the last complete purge of the charm purge engine.
+PURGE_KEY = 'zookeeper.purge.last'
+PURGE_MODES = ('zookeeper', 'charm')
+
+# Results of the state probe, kept for the rest of the hook. Cleared
+# whenever the service is started, restarted or stopped, which is also
+# recorded here ('started'); see started_in_hook.
+_probe_cache = {}
+
+# Peer snapshots, kept for the rest of the hook; see peer_snapshot.
+_peer_cache = {}
+
+
+def check_zookeeper():
+    '''
+    Return the check_zookeeper.py module shipped in the charm's files
+    directory, which provides the 4 letter word client and parsers.
+
+    '''
+    if 'module' not in _probe_cache:
+        path = os.path.join(hookenv.charm_dir(), 'files', 'check_zookeeper.py')
+        spec = importlib.util.spec_from_file_location('check_zookeeper', path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _probe_cache['module'] = module
+    return _probe_cache['module']
+
+
+def format_node(unit, node_ip, peer_type='participant'):
+    '''
+    Given a juju unit name, an ip address and a peer type, return a
+    tuple containing an id and formatted ip string suitable for passing
+    to zoo.cfg templates. Observers get an ':observer' suffix.
+
+    '''
+    node = "{ip}:2888:3888".format(ip=node_ip)
+    if peer_type == 'observer':
+        node += ':observer'
+    return (unit.split("/")[1], node)
+
+
+def is_observer(node):
+    '''
+    Whether a node, as returned by format_node, is an observer.
+
+    '''
+    return node[1].endswith(':observer')
+
+
+def peer_types(units, max_participants):
+    '''
+    Return the peer type of each of the given units, by unit name: the
+    max_participants units with the lowest unit numbers are
+    'participant', the others 'observer'. All units participate when
+    max_participants is 0.
+
+    Every unit applies this same rule to the same units, so that they all
+    agree on the role of each node without exchanging it.
+
+    '''
+    units = sorted(units, key=lambda unit: int(unit.split('/')[1]))
+    return {unit: ('participant'
+                   if not max_participants or index < max_participants
+                   else 'observer')
+            for index, unit in enumerate(units)}
+
+
+def _ensemble_peer_types():
+    '''
+    Return the peer type of this unit and of each of its peers, by unit
+    name. Raises ValueError if the max_participants option is invalid.
+
+    '''
+    max_participants = _config_int(hookenv.config(), 'max_participants', 0)
+    units = {hookenv.local_unit()}
+    units.update(unit for rid in hookenv.relation_ids('zkpeer')
+                 for unit in hookenv.related_units(rid))
+    return peer_types(units, max_participants)
+
+
+def local_peer_type():
+    '''
+    Return the peer type of this unit, as given by peer_types. Raises
+    ValueError if the max_participants option is invalid.
+
+    '''
+    return _ensemble_peer_types()[hookenv.local_unit()]
 
 
-def format_node(unit, node_ip):
+class PeerSnapshot(object):
     '''
-    Given a juju unit name and an ip address, return a tuple
-    containing an id and formatted ip string suitable for passing to
-    zoo.cfg templates.
+    The nodes of the ensemble as seen from this unit, formatted by
+    format_node, with this unit first.
 
     '''
-    return (unit.split("/")[1], "{ip}:2888:3888".format(ip=node_ip))
+
+    def __init__(self, nodes):
+        self.nodes = tuple(nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def ips(self):
+        return [node[1].split(':')[0] for node in self.nodes]
+
+    @property
+    def participants(self):
+        '''
+        The nodes voting in the quorum.
+
+        '''
+        return [node for node in self.nodes if not is_observer(node)]
+
+    @property
+    def observers(self):
+        '''
+        The nodes following the ensemble without voting.
+
+        '''
+        return [node for node in self.nodes if is_observer(node)]
+
+
+def peer_snapshot():
+    '''
+    Return the PeerSnapshot of this hook.
+
+    Relation data does not change during a hook, so the peers are only
+    read once from the relation; the snapshot is taken again once the
+    peer relation becomes available.
+
+    '''
+    zkpeer = RelationBase.from_state('zkpeer.joined')
+    key = zkpeer is not None
+    if key not in _peer_cache:
+        try:
+            types = _ensemble_peer_types()
+        except ValueError:
+            # configure reports the invalid option.
+            types = {}
+        local_unit = hookenv.local_unit()
+        # A Zookeeper node likes to be first on the list.
+        nodes = [(local_unit, hookenv.unit_private_ip(),
+                  types.get(local_unit, 'participant'))]
+        # Get the list of peers
+        if zkpeer:
+            nodes.extend((unit, ip, types.get(unit, 'participant'))
+                         for unit, ip in sorted(zkpeer.get_nodes()))
+        _peer_cache[key] = PeerSnapshot(
+            format_node(*node) for node in nodes)
+    return _peer_cache[key]
+
+
+def host_memory_mb():
+    '''
+    Return the total memory of the host in MB, or None if unknown.
+
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def java_major_version():
+    '''
+    Return the major version of the default JVM, from the location of
+    the java alternative (e.g. /usr/lib/jvm/java-11-openjdk-amd64), or
+    None if unknown.
+
+    '''
+    m = re.search(r'java-(?:1\.)?(\d+)-',
+                  os.path.realpath('/usr/bin/java'))
+    return int(m.group(1)) if m else None
+
+
+def auto_heap_mb(memory_mb, data_size=None):
+    '''
+    Size the heap of a dedicated Zookeeper host: half of the memory,
+    raised to three times the in-memory data size when that is larger
+    (but never over three quarters of the memory), rounded up to 256MB
+    and bounded by MIN_HEAP_MB and MAX_HEAP_MB.
+
+    '''
+    heap = memory_mb // 2
+    if data_size:
+        heap = max(heap, min(3 * data_size // (1024 * 1024),
+                             memory_mb * 3 // 4))
+    heap = -(-heap // 256) * 256
+    return max(MIN_HEAP_MB, min(heap, MAX_HEAP_MB))
+
+
+def jvm_options(cfg, heap_mb=None):
+    '''
+    Return the heap, garbage collector and GC logging options of the
+    server JVM, from the heap_size, gc_collector and gc_logging config
+    options. `heap_mb` is the size of an "auto" heap (see
+    Zookeeper.heap_mb); the JVM default is left when it is None.
+
+    '''
+    options = []
+
+    heap = cfg.get('heap_size')
+    heap = 'auto' if heap is None else str(heap).strip().lower()
+    if heap == 'auto':
+        heap = '{}m'.format(heap_mb) if heap_mb else None
+    if heap:
+        # A fixed size heap is never resized, which avoids full GCs.
+        options += ['-Xms{}'.format(heap), '-Xmx{}'.format(heap)]
+
+    collector = str(cfg.get('gc_collector') or '').strip().lower()
+    if collector == 'cms' and \
+            (java_major_version() or 8) >= NO_CMS_JAVA_VERSION:
+        # The JVM refuses to start with a collector it no longer has.
+        hookenv.log('The CMS collector was removed in Java {}; using G1 '
+                    'instead'.format(NO_CMS_JAVA_VERSION), level='WARN')
+        collector = 'g1'
+    if collector == 'g1':
+        options += ['-XX:+UseG1GC', '-XX:MaxGCPauseMillis=50',
+                    '-XX:+ParallelRefProcEnabled']
+    elif collector == 'parallel':
+        options += ['-XX:+UseParallelGC']
+    elif collector == 'cms':
+        options += ['-XX:+UseConcMarkSweepGC',
+                    '-XX:+CMSParallelRemarkEnabled']
+
+    if cfg.get('gc_logging'):
+        if (java_major_version() or 8) >= 9:
+            options += ['-Xlog:gc*:file={}:time,uptime:'
+                        'filecount=5,filesize=20M'.format(GC_LOG)]
+        else:
+            options += ['-Xloggc:{}'.format(GC_LOG), '-XX:+PrintGCDetails',
+                        '-XX:+PrintGCDateStamps', '-XX:+UseGCLogFileRotation',
+                        '-XX:NumberOfGCLogFiles=5', '-XX:GCLogFileSize=20M']
+
+    return options
+
+
+def _config_int(cfg, key, minimum, auto=False):
+    '''
+    Return the config option `key` as an int no lower than `minimum`,
+    or 'auto' if `auto` is set and the option is "auto". Raises
+    ValueError with a message fit for the unit status otherwise.
+
+    '''
+    value = str(cfg.get(key) or '').strip().lower()
+    if auto and value == 'auto':
+        return 'auto'
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        raise ValueError('invalid {}: "{}", expected {}an integer of at '
+                         'least {}'.format(key, cfg.get(key),
+                                           '"auto" or ' if auto else '',
+                                           minimum))
+    return number
+
+
+def prometheus_port(cfg):
+    '''
+    Return the port of the Prometheus exporter from the prometheus_port
+    config option, or None if it is disabled. Raises ValueError with a
+    message fit for the unit status if it is not a port number.
+
+    '''
+    if not str(cfg.get('prometheus_port') or '').strip():
+        return None
+    port = _config_int(cfg, 'prometheus_port', 1)
+    if port > 65535:
+        raise ValueError('invalid prometheus_port: "{}", expected a port '
+                         'number'.format(cfg.get('prometheus_port')))
+    return port
+
+
+def auto_init_limit(tick_time, snapshot_size=None):
+    '''
+    Return the number of ticks a follower needs to sync a snapshot of
+    `snapshot_size` bytes, twice over for headroom, rounded up to 10
+    ticks and no lower than MIN_INIT_LIMIT.
+
+    '''
+    ms = 2 * 1000 * (snapshot_size or 0) / SYNC_BYTES_PER_SEC
+    ticks = -(-int(ms) // tick_time)
+    return max(MIN_INIT_LIMIT, -(-ticks // 10) * 10)
+
+
+def auto_max_client_cnxns(client_units):
+    '''
+    Return the per address connection limit for the given number of
+    related client units, rounded up to a multiple of
+    MIN_MAX_CLIENT_CNXNS so that it rarely changes.
+
+    '''
+    cnxns = client_units * CLIENT_CNXNS_PER_UNIT
+    return max(MIN_MAX_CLIENT_CNXNS,
+               -(-cnxns // MIN_MAX_CLIENT_CNXNS) * MIN_MAX_CLIENT_CNXNS)
+
+
+def zookeeper_version():
+    '''
+    Return the version of the installed zookeeper package as a tuple of
+    ints, or None if it cannot be determined.
+
+    '''
+    with timer('apt:get_package_version'):
+        version = apt.get_package_version(APP_NAME) or ''
+    m = re.match(r'(?:\d+:)?(\d+)\.(\d+)\.(\d+)', version)
+    if m is None:
+        return None
+    return tuple(int(part) for part in m.groups())
+
+
+def super_digest(secret):
+    '''
+    Return the DigestAuthenticationProvider digest of the 'super' user
+    for the given password.
+
+    '''
+    digest = hashlib.sha1('super:{}'.format(secret).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def _check_output(cmd, **kwargs):
+    '''
+    subprocess.check_output, timed when profiling is enabled.
+
+    '''
+    name = 'subprocess:{}'.format(' '.join(
+        [os.path.basename(cmd[0])] + [arg for arg in cmd[1:2]
+                                      if not arg.startswith('-')]))
+    with timer(name):
+        return subprocess.check_output(cmd, **kwargs)
+
+
+def write_if_changed(path, content, owner='root', group='root',
+                     perms=0o644):
+    '''
+    Atomically replace the file at `path` with `content`, unless it
+    already holds exactly that content. Returns whether it was written.
+
+    '''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    try:
+        with open(path, 'rb') as f:
+            current = hashlib.sha256(f.read()).digest()
+    except OSError:
+        current = None
+    if current == hashlib.sha256(content).digest():
+        return False
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix='.{}.'.format(os.path.basename(
+                                        path)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chown(tmp_path, pwd.getpwnam(owner).pw_uid,
+                 grp.getgrnam(group).gr_gid)
+        os.chmod(tmp_path, perms)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
+def format_dynamic_node(node_id, node):
+    '''
+    Given a node as returned by format_node, return its id and its
+    server spec in the dynamic config file format, which includes the
+    role and the client address.
+
+    '''
+    ip, quorum_port, election_port = node.split(':')[:3]
+    role = 'observer' if node.endswith(':observer') else 'participant'
+    return (node_id, "{ip}:{quorum}:{election}:{role};{ip}:{port}".format(
+        ip=ip, quorum=quorum_port, election=election_port, role=role,
+        port=ZK_PORT))
 
 
 class Zookeeper(object):
@@ -55,18 +479,371 @@ class Zookeeper(object):
         and that this command can fail, depending on the state that
         the Zookeeper node is in when we attempt to run it.
 
+        '''
+        return self.probe()['mode'] == 'leader'
+
+    def probe(self):
+        '''
+        Ask the local server whether it is running and in which mode,
+        using the 'ruok' and 'srvr' 4 letter words on the client port.
+
+        Returns a dict with 'running' (the process answers) and 'mode'
+        (leader, follower, standalone or observer; None when it is not
+        serving requests). The result is kept for the rest of the hook.
+        Falls back to `zkServer.sh status` if the 4 letter words are
+        disabled on the server.
+
+        '''
+        if 'state' in _probe_cache:
+            return _probe_cache['state']
+
+        # Hooks run as root: keep away from the files that the monitoring
+        # checks, run as other users, keep their samples in.
+        zk = check_zookeeper().ZooKeeperServer(
+            hookenv.unit_private_ip(), ZK_PORT, persist=False)
+        try:
+            running = zk._send_cmd('ruok') == b'imok'
+            mode = zk.get_server_info().get('zk_server_state')
+        except socket.error:
+            running, mode = False, None
+        else:
+            if not running and mode is None:
+                running, mode = self._status()
+
+        state = {'running': running, 'mode': mode if mode in ZK_MODES
+                 else None}
+        _probe_cache['state'] = state
+        return state
+
+    def started_in_hook(self):
+        '''
+        Whether the service was started or restarted during this hook.
+
+        '''
+        return _probe_cache.get('started', False)
+
+    def wait_until_ready(self, timeout=60, delay=0.5, max_delay=8,
+                         progress=None):
+        '''
+        Probe the server until it serves requests in one of ZK_MODES,
+        doubling the pause between probes up to `max_delay` seconds, for
+        at most `timeout` seconds.
+
+        `progress`, if given, is called with each probe result that is
+        not ready yet. Returns the last probe result.
+
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            _probe_cache.pop('state', None)
+            state = self.probe()
+            remaining = deadline - time.monotonic()
+            if state['mode'] is not None or remaining <= 0:
+                return state
+
+            if progress is not None:
+                progress(state)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+    def down_peers(self, ips, timeout=1):
+        '''
+        Return the ips, among `ips`, of the servers that do not serve
+        requests, asked with the 'srvr' 4 letter word on their client
+        port.
+
+        '''
+        down = []
+        for ip in ips:
+            zk = check_zookeeper().ZooKeeperServer(
+                ip, ZK_PORT, timeout, persist=False)
+            try:
+                mode = zk.get_server_info().get('zk_server_state')
+            except socket.error:
+                mode = None
+            if mode not in ZK_MODES:
+                down.append(ip)
+        return down
+
+    def approximate_data_size(self):
+        '''
+        Return the size in bytes of the data tree of the running server,
+        as reported by 'mntr', or None if it is not available.
+
+        '''
+        zk = check_zookeeper().ZooKeeperServer(
+            hookenv.unit_private_ip(), ZK_PORT, persist=False)
+        try:
+            # A bare 'mntr': this is not a monitoring sample, and must not
+            # move the rate baseline or the history of the checks.
+            stats = zk._parse(zk._send_cmd_lines('mntr'))
+            size = stats.get('zk_approximate_data_size')
+        except socket.error:
+            return None
+        return size if isinstance(size, int) else None
+
+    def heap_mb(self, refresh=False):
+        '''
+        Return the heap size in MB for an "auto" heap_size, from
+        auto_heap_mb, or None if the host memory is unknown.
+
+        Like the "auto" tunables, it is derived once, then kept until
+        `refresh` is set: a new size restarts the server. It is never
+        lowered because the server did not report its data size, as when
+        it is down.
+
+        '''
+        kv = unitdata.kv()
+        heap = kv.get(AUTO_HEAP_KEY)
+        if heap is None or refresh:
+            memory = host_memory_mb()
+            if not memory:
+                return heap
+            data_size = self.approximate_data_size()
+            derived = auto_heap_mb(memory, data_size)
+            if heap is None or data_size is not None:
+                heap = derived
+            else:
+                heap = max(heap, derived)
+            kv.set(AUTO_HEAP_KEY, heap)
+        return heap
+
+    def txlog_dir(self):
+        '''
+        Return the directory the transaction logs are written to.
+
+        '''
+        kv = unitdata.kv()
+        return (kv.get('zookeeper.storage.txlog_dir') or
+                kv.get('zookeeper.storage.data_dir', APP_DATADIR))
+
+    def benchmark_storage(self, count=200):
+        '''
+        Measure the fsync latency of the transaction log storage with
+        fsync_benchmark, and record the result in unitdata.
+
+        '''
+        hookenv.status_set('maintenance', 'measuring storage fsync latency')
+        result = fsync_benchmark(self.txlog_dir(), count)
+        hookenv.log('fsync latency of {directory}: p50 {p50_ms}ms, p95 '
+                    '{p95_ms}ms, p99 {p99_ms}ms, max {max_ms}ms'.format(
+                        **result))
+        unitdata.kv().set(FSYNC_KEY, result)
+        return result
+
+    def storage_benchmarked(self):
+        '''
+        Whether the current transaction log storage has been benchmarked.
+
+        '''
+        result = unitdata.kv().get(FSYNC_KEY)
+        return bool(result) and result['directory'] == self.txlog_dir()
+
+    def ready_message(self):
+        '''
+        Return the message of the active status: the quorum check, and a
+        warning when the transaction log storage was found slow.
+
+        '''
+        message = 'ready {}'.format(self.quorum_check())
+        result = unitdata.kv().get(FSYNC_KEY)
+        if result and result['p99_ms'] > FSYNC_WARN_MS:
+            message += '; slow storage: fsync p99 {:.0f}ms'.format(
+                result['p99_ms'])
+        return message
+
+    def purge_settings(self):
+        '''
+        Return the settings of the purge engine, from the autopurge_* and
+        purge_* config options. Raises ValueError if one of them is
+        invalid.
+
+        '''
+        cfg = hookenv.config()
+        mode = str(cfg.get('purge_mode') or '').strip().lower()
+        if mode not in PURGE_MODES:
+            raise ValueError('invalid purge_mode: "{}", expected one of '
+                             '{}'.format(cfg.get('purge_mode'),
+                                         ', '.join(PURGE_MODES)))
+        threshold = _config_int(cfg, 'purge_disk_threshold', 0)
+        if threshold > 100:
+            raise ValueError('invalid purge_disk_threshold: "{}", expected '
+                             'a percentage'.format(threshold))
+        return {
+            'mode': mode,
+            'interval': _config_int(cfg, 'autopurge_purge_interval', 0),
+            # Zookeeper never keeps less than 3 snapshots either.
+            'retain_count': max(3, _config_int(
+                cfg, 'autopurge_snap_retain_count', 1)),
+            'disk_threshold': threshold,
+            'retain_hours': _config_int(cfg, 'purge_retain_hours', 0),
+            'retain_size': _config_int(cfg, 'purge_retain_size', 0),
+            'rate': _config_int(cfg, 'purge_rate', 0),
+        }
+
+    def purge(self, force=False, dry_run=False, deadline=None):
+        '''
+        Delete the old snapshots and transaction logs, as planned by
+        purge_plan from the purge settings.
+
+        Unless forced, this only happens every autopurge_purge_interval
+        hours, or when the data or log filesystem is used over
+        purge_disk_threshold percent; snapshots are then no longer kept
+        for their age. Files are deleted at the purge_rate pace, and
+        nothing more is deleted past the `deadline` (a time.monotonic
+        value), leaving the rest, possibly a partly truncated file, for
+        the next run.
+
+        Returns a summary of the purge, or None if none was due, or if
+        neither directory exists yet.
+
+        '''
+        settings = self.purge_settings()
+        kv = unitdata.kv()
+        data_dir = kv.get('zookeeper.storage.data_dir', APP_DATADIR)
+        txlog_dir = self.txlog_dir()
+
+        directories = [directory for directory in (data_dir, txlog_dir)
+                       if os.path.isdir(directory)]
+        if not directories:
+            # Zookeeper has not written anything yet.
+            return None
+        usage = max(disk_usage_percent(directory)
+                    for directory in directories)
+        pressure = bool(settings['disk_threshold']) and \
+            usage >= settings['disk_threshold']
+        due = bool(settings['interval']) and \
+            time.time() - kv.get(PURGE_KEY, 0) >= settings['interval'] * 3600
+        if not (force or pressure or due):
+            return None
+
+        files = purge_plan(
+            data_dir, txlog_dir, settings['retain_count'],
+            0 if pressure else settings['retain_hours'] * 3600,
+            settings['retain_size'] * 1024 * 1024)
+        summary = {'disk_usage': round(usage, 1), 'pressure': pressure,
+                   'files': [], 'freed': 0, 'complete': True}
+        for path in files:
+            if deadline is not None and time.monotonic() >= deadline:
+                summary['complete'] = False
+                break
+            if dry_run:
+                summary['freed'] += os.path.getsize(path)
+            else:
+                summary['freed'] += throttled_unlink(
+                    path, settings['rate'] * 1024 * 1024, deadline=deadline)
+                if os.path.exists(path):
+                    # stopped at the deadline, midway through the file
+                    summary['complete'] = False
+                    break
+            summary['files'].append(os.path.basename(path))
+
+        if summary['complete'] and not dry_run:
+            kv.set(PURGE_KEY, time.time())
+        hookenv.log('Purged {} files ({} bytes) at {}% disk usage{}'.format(
+            len(summary['files']), summary['freed'], summary['disk_usage'],
+            '' if summary['complete'] else ', more left for the next run'))
+        return summary
+
+    def client_units(self):
+        '''
+        Return the number of units related over the zookeeper relation.
+
+        '''
+        return sum(len(hookenv.related_units(rid))
+                   for rid in hookenv.relation_ids('zookeeper'))
+
+    def tunables(self, refresh=False):
+        '''
+        Return the tickTime, initLimit, syncLimit, maxClientCnxns and
+        peerType of the server, from the tick_time, init_limit,
+        sync_limit, max_client_cnxns and max_participants config
+        options. Raises ValueError if one of them is invalid.
+
+        The "auto" values come from auto_tunables. They are derived once,
+        then kept until `refresh` is set: a new value restarts the
+        server, which is left to the rolling restart, rather than done on
+        every unit at once from the hook that noticed it.
+
+        '''
+        cfg = hookenv.config()
+        tunables = {
+            'tick_time': _config_int(cfg, 'tick_time', 1),
+            'init_limit': _config_int(cfg, 'init_limit', 1, auto=True),
+            'sync_limit': _config_int(cfg, 'sync_limit', 1),
+            'max_client_cnxns': _config_int(cfg, 'max_client_cnxns', 0,
+                                            auto=True),
+            'peer_type': local_peer_type(),
+        }
+
+        kv = unitdata.kv()
+        applied = kv.get(AUTO_TUNABLES_KEY) or {}
+        if refresh or any(value == 'auto' and key not in applied
+                          for key, value in tunables.items()):
+            applied = dict(applied, **self.auto_tunables())
+            kv.set(AUTO_TUNABLES_KEY, applied)
+        for key, value in tunables.items():
+            if value == 'auto':
+                tunables[key] = applied[key]
+        return tunables
+
+    def auto_tunables(self):
+        '''
+        Return the values currently derived for the tunables set to
+        "auto", by option name. Raises ValueError if the options are
+        invalid.
+
+        An "auto" initLimit is sized from the newest snapshot, and never
+        lowered, so that it does not flap as snapshots are taken. An
+        "auto" maxClientCnxns is sized from the number of related client
+        units.
+
+        '''
+        cfg = hookenv.config()
+        kv = unitdata.kv()
+        auto = {}
+        if _config_int(cfg, 'init_limit', 1, auto=True) == 'auto':
+            datadir = kv.get('zookeeper.storage.data_dir', APP_DATADIR)
+            auto['init_limit'] = max(
+                auto_init_limit(_config_int(cfg, 'tick_time', 1),
+                                latest_snapshot_size(datadir)),
+                (kv.get(AUTO_TUNABLES_KEY) or {}).get('init_limit', 0))
+        if _config_int(cfg, 'max_client_cnxns', 0, auto=True) == 'auto':
+            auto['max_client_cnxns'] = auto_max_client_cnxns(
+                self.client_units())
+        return auto
+
+    def auto_tunables_changed(self):
+        '''
+        Whether the values derived for the "auto" tunables differ from
+        the ones the server runs with. Raises ValueError if the options
+        are invalid.
+
+        '''
+        applied = unitdata.kv().get(AUTO_TUNABLES_KEY) or {}
+        return any(applied.get(key) != value
+                   for key, value in self.auto_tunables().items())
+
+    def _status(self):
+        '''
+        Run `zkServer.sh status` and return whether the server is
+        running, and its mode.
+
         '''
         try:
-            status = subprocess.check_output(
+            status = _check_output(
                 ["/usr/share/{}/bin/zkServer.sh".format(APP_NAME), "status"])
-            return "leader" in status.decode('utf-8')
         except Exception:
             hookenv.log(
-                "Unable to determine whether this node is the Zookeeper "
-                "leader.",
+                "Unable to determine the state of this Zookeeper node.",
                 level="WARN"
             )
-            return False
+            return False, None
+
+        for mode in ZK_MODES:
+            if mode in status.decode('utf-8'):
+                return True, mode
+        return False, None
 
     def read_peers(self):
         '''
@@ -76,14 +853,25 @@ class Zookeeper(object):
         this code is executing on.
 
         '''
-        # A Zookeeper node likes to be first on the list.
-        nodes = [(hookenv.local_unit(), hookenv.unit_private_ip())]
-        # Get the list of peers
-        zkpeer = RelationBase.from_state('zkpeer.joined')
-        if zkpeer:
-            nodes.extend(sorted(zkpeer.get_nodes()))
-        nodes = [format_node(*node) for node in nodes]
-        return nodes
+        return list(peer_snapshot().nodes)
+
+    def joining_ensemble(self):
+        '''
+        Return the nodes to list in the dynamic config file of a server
+        starting for the first time: the ensemble recorded by the Juju
+        leader, with this node, so that the server joins the running
+        ensemble instead of forming one of its own. The leader then adds
+        it with reconfig (see check_cluster). Before there is an
+        ensemble, the peers of this unit.
+
+        '''
+        peers = self.read_peers()
+        ensemble = [tuple(node) for node in
+                    json.loads(leader_get('ensemble') or '[]')]
+        if not ensemble:
+            return peers
+        return peers[:1] + [node for node in ensemble
+                            if node[0] != peers[0][0]]
 
     def sort_peers(self, zkpeer):
         '''
@@ -97,44 +885,157 @@ class Zookeeper(object):
 
         return peers
 
-    def install(self, nodes=None):
+    def supports_reconfig(self):
+        '''
+        Whether the installed Zookeeper can change the ensemble
+        membership at runtime, with a dynamic config file.
+
+        '''
+        version = zookeeper_version()
+        return version is not None and version >= RECONFIG_VERSION
+
+    def dynamic_config_path(self):
+        '''
+        Return the dynamic config file currently in use. Zookeeper
+        writes a new versioned file on every reconfig, and points the
+        dynamicConfigFile setting of zoo.cfg at it.
+
+        '''
+        try:
+            with open(os.path.join(APP_COMMON, 'zoo.cfg')) as f:
+                for line in f:
+                    key, _, value = line.strip().partition('=')
+                    if key == 'dynamicConfigFile' and value:
+                        return value
+        except OSError:
+            pass
+        return os.path.join(APP_COMMON, 'zoo.cfg.dynamic')
+
+    def install(self, nodes=None, reset_membership=False,
+                refresh_tunables=False):
         '''
         Write out the config, then restart services.
 
         After this runs, we should have a configured and running service.
+        Raises ValueError if the tunables in the config are invalid.
+
+        The files are rendered in memory first, and only written (each
+        atomically) when their content differs from the installed one.
+        The service is only restarted when a file changed, or when it is
+        not running. Returns whether any file changed.
+
+        When dynamic reconfiguration is supported, the ensemble lives in
+        a dynamic config file that Zookeeper owns once it runs. That file
+        is only written when it does not exist yet, or when
+        `reset_membership` is set (for instance, during a rolling
+        restart): a new server lists the running ensemble and itself,
+        see joining_ensemble. `refresh_tunables` derives the "auto"
+        tunables and heap size again, see tunables and heap_mb.
         '''
         cfg = hookenv.config()
         myid = hookenv.local_unit().split('/')[1]
         datadir = unitdata.kv().get('zookeeper.storage.data_dir',
                                     os.path.join(APP_DATADIR))
         os.makedirs(datadir, exist_ok=True)
+        datalogdir = unitdata.kv().get('zookeeper.storage.txlog_dir')
+        if datalogdir:
+            os.makedirs(datalogdir, exist_ok=True)
+        java_opts = jvm_options(cfg, self.heap_mb(refresh_tunables))
+        dynamic_config = None
+        if self.supports_reconfig():
+            dynamic_config = self.dynamic_config_path()
+            secret = leader_get('reconfig_secret')
+            if secret:
+                java_opts.append(
+                    '-Dzookeeper.DigestAuthenticationProvider.superDigest='
+                    'super:{}'.format(super_digest(secret)))
         context = {
             'myid': myid,
             'datadir': datadir,
+            'datalogdir': datalogdir,
             'ensemble': self.read_peers(),
             'client_bind_addr': hookenv.unit_private_ip(),
             'port': ZK_PORT,
-            'autopurge_purge_interval': cfg.get(
-            'autopurge_purge_interval'),
+            # The purge engine of the charm replaces Zookeeper's own.
+            'autopurge_purge_interval': 0 if cfg.get(
+                'purge_mode') == 'charm' else cfg.get(
+                'autopurge_purge_interval'),
             'autopurge_snap_retain_count': cfg.get(
             'autopurge_snap_retain_count'),
             'jmx_port': cfg.get('jmx_port'),
+            'dynamic_config': dynamic_config,
+            'java_opts': ' '.join(java_opts),
         }
+        context.update(self.tunables(refresh_tunables))
 
-        for file_config in ('zoo.cfg', 'environment'):
-            render(
-                source=file_config,
-                target=os.path.join(APP_COMMON, file_config),
-                owner='root',
-                perms=0o644,
-                context=context
-            )
-        with open(os.path.join(datadir, 'myid'), 'w') as f:
-            f.write(myid)
-        self.restart()
+        with timer('render'):
+            files = [(os.path.join(APP_COMMON, file_config),
+                      render(source=file_config, target=None,
+                             context=context))
+                     for file_config in ('zoo.cfg', 'environment')]
+            if dynamic_config and reset_membership:
+                files.append((dynamic_config, render(
+                    source='zoo.cfg.dynamic', target=None,
+                    context=context)))
+            elif dynamic_config and not os.path.exists(dynamic_config):
+                files.append((dynamic_config, render(
+                    source='zoo.cfg.dynamic', target=None,
+                    context=dict(context,
+                                 ensemble=self.joining_ensemble()))))
+        files.append((os.path.join(datadir, 'myid'), myid))
+
+        changed = [path for path, content in files
+                   if write_if_changed(path, content)]
+        if changed or not self.is_running():
+            hookenv.log('Restarting Zookeeper; changed files: {}'.format(
+                ', '.join(changed) or 'none'))
+            self.restart()
+        else:
+            hookenv.log('Zookeeper configuration unchanged; not restarting')
         if self.is_zk_leader():
             zkpeer = RelationBase.from_state('zkpeer.joined')
             zkpeer.set_zk_leader()
+        return bool(changed)
+
+    def reconfig(self, joining=(), leaving=()):
+        '''
+        Add the `joining` nodes to, and remove the `leaving` nodes from,
+        the running ensemble with Zookeeper's dynamic reconfiguration.
+        Nodes are given as returned by read_peers.
+
+        Returns True when the new configuration was committed.
+
+        '''
+        secret = leader_get('reconfig_secret')
+        if not secret or not (joining or leaving):
+            return False
+
+        command = ['reconfig']
+        if joining:
+            command += ['-add', ','.join(
+                'server.{}={}'.format(*format_dynamic_node(*node))
+                for node in joining)]
+        if leaving:
+            command += ['-remove', ','.join(node[0] for node in leaving)]
+
+        script = 'addauth digest super:{}\n{}\nquit\n'.format(
+            secret, ' '.join(command))
+        try:
+            output = _check_output(
+                ["/usr/share/{}/bin/zkCli.sh".format(APP_NAME), "-server",
+                 "{}:{}".format(hookenv.unit_private_ip(), ZK_PORT)],
+                input=script.encode(), stderr=subprocess.STDOUT,
+                timeout=60)
+        except Exception as e:
+            hookenv.log("Unable to reconfigure the ensemble: {}".format(e),
+                        level="WARN")
+            return False
+
+        committed = b'Committed new configuration' in output
+        if not committed:
+            hookenv.log("Reconfiguration was not committed: {}".format(
+                output.decode('utf-8', 'replace')), level="WARN")
+        return committed
 
     def start(self):
         '''
@@ -147,8 +1048,10 @@ class Zookeeper(object):
         the Zookeeper node is in when we attempt to run it.
 
         '''
+        _probe_cache.pop('state', None)
+        _probe_cache['started'] = True
         try:
-            status = subprocess.check_output(
+            status = _check_output(
                 ["/usr/share/{}/bin/zkServer.sh".format(APP_NAME), "start"])
             return "STARTED" in status.decode('utf-8')
         except Exception:
@@ -164,8 +1067,10 @@ class Zookeeper(object):
         Restart zookeeper.
 
         '''
+        _probe_cache.pop('state', None)
+        _probe_cache['started'] = True
         try:
-            status = subprocess.check_output(
+            status = _check_output(
                 ["/usr/share/{}/bin/zkServer.sh".format(APP_NAME), "restart"])
             return "STARTED" in status.decode('utf-8')
         except Exception:
@@ -181,8 +1086,9 @@ class Zookeeper(object):
         Stop zookeeper.
 
         '''
+        _probe_cache.pop('state', None)
         try:
-            status = subprocess.check_output(
+            status = _check_output(
                 ["/usr/share/{}/bin/zkServer.sh".format(APP_NAME), "stop"])
             return "STOPPED" in status.decode('utf-8')
         except Exception:
@@ -194,19 +1100,7 @@ class Zookeeper(object):
             return False
 
     def is_running(self):
-        try:
-            status = subprocess.check_output(
-                ["/usr/share/{}/bin/zkServer.sh".format(APP_NAME), "status"])
-            return ("follower" in status.decode('utf-8') or
-                   "standalone" in status.decode('utf-8') or
-                   "leader" in status.decode('utf-8'))
-        except Exception:
-            hookenv.log(
-                "Unable to determine whether this node is the Zookeeper "
-                "leader.",
-                level="WARN"
-            )
-            return False
+        return self.probe()['mode'] is not None
 
     def open_ports(self):
         '''
@@ -229,12 +1123,20 @@ class Zookeeper(object):
         or is even (meaning that one of the nodes is redundant for
         quorum).
 
+        Observers do not vote, so they are reported separately and left
+        out of the quorum accounting.
+
         '''
-        node_count = len(self.read_peers())
+        snapshot = peer_snapshot()
+        node_count = len(snapshot.participants)
         if node_count == 1:
             count_str = "{} unit".format(node_count)
         else:
             count_str = "{} units".format(node_count)
+        observers = len(snapshot.observers)
+        if observers:
+            count_str += ", {} observer{}".format(
+                observers, '' if observers == 1 else 's')
         if node_count < 3:
             return " ({}; less than 3 is suboptimal)".format(count_str)
         if node_count % 2 == 0:
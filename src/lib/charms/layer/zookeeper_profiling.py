@@ -0,0 +1,132 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Opt-in timing of the charm's reactive handlers and of the slow calls
+they make (subprocesses, template rendering, package queries).
+
+Timings are kept in unitdata, as the last HISTORY_SIZE durations of each
+named operation, and summarized by the profile-report action. Nothing
+is recorded unless the `profiling` config option is set.
+
+'''
+
+import os
+import time
+
+from contextlib import contextmanager
+
+from charmhelpers.core import hookenv, unitdata
+
+
+PROFILE_KEY = 'zookeeper.profile'
+HISTORY_SIZE = 200
+
+
+def enabled():
+    return bool(hookenv.config().get('profiling'))
+
+
+def record(name, seconds):
+    '''
+    Append a duration, in seconds, to the history of `name`.
+
+    '''
+    kv = unitdata.kv()
+    timings = kv.get(PROFILE_KEY, {})
+    history = timings.setdefault(name, [])
+    history.append(round(seconds, 6))
+    del history[:-HISTORY_SIZE]
+    kv.set(PROFILE_KEY, timings)
+
+
+@contextmanager
+def timer(name):
+    '''
+    Record how long the body of the `with` block takes, if profiling is
+    enabled.
+
+    '''
+    if not enabled():
+        yield
+        return
+
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, time.monotonic() - start)
+
+
+def instrument_handlers():
+    '''
+    Time every handler from the charm's reactive directory that runs for
+    the rest of this hook, by wrapping the dispatch of charms.reactive.
+
+    '''
+    from charms.reactive.bus import Handler
+
+    if not enabled() or getattr(Handler.invoke, 'profiled', False):
+        return
+
+    reactive_dir = os.path.join(hookenv.charm_dir(), 'reactive')
+    invoke = Handler.invoke
+
+    def profiled_invoke(self):
+        action = self._action
+        filename = action.__code__.co_filename
+        if os.path.dirname(os.path.abspath(filename)) != reactive_dir:
+            return invoke(self)
+
+        name = 'handler:{}.{}'.format(
+            os.path.splitext(os.path.basename(filename))[0],
+            action.__name__)
+        with timer(name):
+            return invoke(self)
+
+    profiled_invoke.profiled = True
+    Handler.invoke = profiled_invoke
+
+
+def _percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def report():
+    '''
+    Return the count, p50, p95 and max duration, in seconds, of every
+    recorded operation.
+
+    '''
+    summary = {}
+    for name, history in unitdata.kv().get(PROFILE_KEY, {}).items():
+        if not history:
+            continue
+        values = sorted(history)
+        summary[name] = {
+            'count': len(values),
+            'p50': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'max': values[-1],
+        }
+    return summary
+
+
+def reset():
+    '''
+    Drop all the recorded timings.
+
+    '''
+    unitdata.kv().unset(PROFILE_KEY)
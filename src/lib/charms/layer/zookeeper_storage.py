@@ -0,0 +1,491 @@
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Helpers managing the files Zookeeper keeps in its data directories.
+
+Zookeeper stores its snapshots (snapshot.<zxid>) in `dataDir`, and its
+transaction logs (log.<zxid>) in `dataLogDir`, which defaults to
+`dataDir`. Both live in a `version-2` subdirectory.
+
+'''
+
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+
+from charmhelpers.core import hookenv
+
+
+VERSION_DIR = 'version-2'
+SNAPSHOT_PREFIX = 'snapshot.'
+TXLOG_PREFIX = 'log.'
+# Files where a server of the ensemble records the epochs it has seen,
+# next to the snapshots. They only match the data they were written with.
+EPOCH_FILES = ('acceptedEpoch', 'currentEpoch', 'updatingEpoch')
+CHUNK_SIZE = 1024 * 1024
+# A complete snapshot ends with the "/" path that marks the end of the
+# data tree, serialized as a 4 bytes length and the path.
+SNAPSHOT_END = b'\x00\x00\x00\x01/'
+# Names of the files found in a backup archive.
+BACKUP_MEMBER = re.compile(r'^{}/(?:snapshot|log)\.[0-9a-f]+$'.format(
+    VERSION_DIR))
+
+
+def list_files(directory, prefix):
+    '''
+    Return the names of the files of the given kind ('snapshot.' or
+    'log.') in the version-2 subdirectory of `directory`, sorted by
+    zxid.
+
+    '''
+    path = os.path.join(directory, VERSION_DIR)
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+
+    files = []
+    for name in names:
+        if not name.startswith(prefix):
+            continue
+        try:
+            files.append((int(name[len(prefix):], 16), name))
+        except ValueError:
+            continue
+    return [name for _, name in sorted(files)]
+
+
+def file_checksum(path):
+    '''
+    Return the SHA-256 hex digest of a file.
+
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def copy_verified(src, dst):
+    '''
+    Copy `src` to `dst` through a temporary file, fsync it, check that
+    its checksum matches the source, then rename it into place. Returns
+    the checksum.
+
+    '''
+    directory = os.path.dirname(dst)
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, '.{}.tmp'.format(os.path.basename(dst)))
+
+    digest = hashlib.sha256()
+    with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            fdst.write(chunk)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copystat(src, tmp)
+
+    checksum = digest.hexdigest()
+    if file_checksum(tmp) != checksum:
+        os.unlink(tmp)
+        raise IOError('checksum mismatch copying {} to {}'.format(src, dst))
+
+    os.replace(tmp, dst)
+    _fsync_dir(directory)
+    return checksum
+
+
+def sync_data(src_dir, dst_dir, copied=None):
+    '''
+    Copy the files of the version-2 subdirectory of `src_dir` (snapshots,
+    transaction logs and epoch files) to `dst_dir`, each verified with
+    copy_verified, and remove the files `dst_dir` has that `src_dir` no
+    longer has.
+
+    Returns the size and modification time of each source file when it
+    was copied. Given back as `copied`, the files that did not change
+    since are skipped, so that a first pass can run while the server is
+    up, and a short catch-up pass once it is stopped.
+
+    '''
+    src = os.path.join(src_dir, VERSION_DIR)
+    dst = os.path.join(dst_dir, VERSION_DIR)
+    os.makedirs(dst, exist_ok=True)
+    copied = dict(copied or {})
+
+    names = set()
+    for entry in os.scandir(src):
+        if not entry.is_file(follow_symlinks=False) or \
+                entry.name.startswith('.'):
+            continue
+        names.add(entry.name)
+        stat = entry.stat()
+        state = (stat.st_size, stat.st_mtime_ns)
+        if copied.get(entry.name) == state and \
+                os.path.exists(os.path.join(dst, entry.name)):
+            continue
+        copy_verified(entry.path, os.path.join(dst, entry.name))
+        copied[entry.name] = state
+
+    for name in os.listdir(dst):
+        if name not in names and not name.startswith('.'):
+            os.unlink(os.path.join(dst, name))
+    _fsync_dir(dst)
+    return {name: state for name, state in copied.items() if name in names}
+
+
+def move_txlogs(src_dir, dst_dir):
+    '''
+    Move the transaction logs of `src_dir` to `dst_dir`. Each log is
+    copied and verified before the original is removed, so an
+    interrupted move leaves a complete copy of every log behind.
+    Zookeeper must be stopped. Returns the number of logs moved.
+
+    '''
+    src = os.path.join(src_dir, VERSION_DIR)
+    dst = os.path.join(dst_dir, VERSION_DIR)
+    os.makedirs(dst, exist_ok=True)
+    if os.path.realpath(src) == os.path.realpath(dst):
+        return 0
+
+    logs = list_files(src_dir, TXLOG_PREFIX)
+    for name in logs:
+        copy_verified(os.path.join(src, name), os.path.join(dst, name))
+        os.unlink(os.path.join(src, name))
+    if logs:
+        _fsync_dir(src)
+        hookenv.log('Moved {} transaction logs from {} to {}'.format(
+            len(logs), src, dst))
+    return len(logs)
+
+
+def latest_snapshot_size(directory):
+    '''
+    Return the size in bytes of the newest snapshot in `directory`, or
+    None if there is none.
+
+    '''
+    snapshots = list_files(directory, SNAPSHOT_PREFIX)
+    if not snapshots:
+        return None
+    try:
+        return os.path.getsize(
+            os.path.join(directory, VERSION_DIR, snapshots[-1]))
+    except OSError:
+        return None
+
+
+def file_zxid(name):
+    '''
+    Return the zxid in the name of a snapshot or transaction log.
+
+    '''
+    return int(name.rsplit('.', 1)[1], 16)
+
+
+def is_complete_snapshot(path):
+    '''
+    Whether the snapshot at `path` was completely written, the way
+    Zookeeper checks it when it picks the snapshot to load.
+
+    '''
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() < 2 * len(SNAPSHOT_END):
+                return False
+            f.seek(-len(SNAPSHOT_END), os.SEEK_END)
+            return f.read() == SNAPSHOT_END
+    except OSError:
+        return False
+
+
+def backup_files(data_dir, txlog_dir=None):
+    '''
+    Return the paths of the files needed to restore the newest complete
+    snapshot of `data_dir`: the snapshot itself, then the transaction
+    log holding the transactions that follow it and every newer log.
+    Returns an empty list if there is no complete snapshot.
+
+    '''
+    txlog_dir = txlog_dir or data_dir
+    snapshots = [name for name in list_files(data_dir, SNAPSHOT_PREFIX)
+                 if is_complete_snapshot(
+                     os.path.join(data_dir, VERSION_DIR, name))]
+    if not snapshots:
+        return []
+    snapshot = snapshots[-1]
+    zxid = file_zxid(snapshot)
+
+    logs = list_files(txlog_dir, TXLOG_PREFIX)
+    # A log is named after its first zxid: the newest log starting at
+    # or before the snapshot holds the transactions right after it.
+    older = [name for name in logs if file_zxid(name) <= zxid]
+    logs = older[-1:] + [name for name in logs if file_zxid(name) > zxid]
+
+    return ([os.path.join(data_dir, VERSION_DIR, snapshot)] +
+            [os.path.join(txlog_dir, VERSION_DIR, name) for name in logs])
+
+
+class _HashingWriter(object):
+    '''
+    File object wrapper computing the SHA-256 of what is written.
+
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def create_backup(data_dir, txlog_dir, archive):
+    '''
+    Write the newest complete snapshot of `data_dir` and the following
+    transaction logs to the gzipped tar file `archive`, and its SHA-256
+    next to it, in `<archive>.sha256`, in the format of sha256sum.
+    Returns the checksum, or None if there is no snapshot to back up.
+
+    The server may keep running: snapshots are never modified once
+    complete, and Zookeeper discards a transaction log entry that was
+    only partly copied when it loads the logs.
+
+    '''
+    files = backup_files(data_dir, txlog_dir)
+    if not files:
+        return None
+
+    directory = os.path.dirname(os.path.abspath(archive))
+    os.makedirs(directory, exist_ok=True)
+    tmp = os.path.join(directory, '.{}.tmp'.format(os.path.basename(archive)))
+    with open(tmp, 'wb') as f:
+        writer = _HashingWriter(f)
+        # Snapshots are large and compress well even at the fastest
+        # level, which keeps the backup from being CPU bound.
+        with gzip.GzipFile(fileobj=writer, mode='wb',
+                           compresslevel=1) as gz:
+            with tarfile.open(fileobj=gz, mode='w|') as tar:
+                for path in files:
+                    tar.add(path, arcname=os.path.join(
+                        VERSION_DIR, os.path.basename(path)))
+        f.flush()
+        os.fsync(f.fileno())
+    checksum = writer.digest.hexdigest()
+    os.replace(tmp, archive)
+    with open('{}.sha256'.format(archive), 'w') as f:
+        f.write('{}  {}\n'.format(checksum, os.path.basename(archive)))
+    hookenv.log('Backed up {} to {}'.format(
+        ', '.join(os.path.basename(path) for path in files), archive))
+    return checksum
+
+
+def restore_backup(archive, data_dir, txlog_dir=None):
+    '''
+    Extract a backup made by create_backup: the snapshot goes to
+    `data_dir`, and the transaction logs to `txlog_dir` (by default
+    `data_dir`). Only snapshots and logs are extracted; each is written
+    to a temporary file and renamed into place. Zookeeper must be
+    stopped. Returns the names of the extracted files.
+
+    '''
+    txlog_dir = txlog_dir or data_dir
+    owner = os.stat(data_dir)
+    extracted = []
+    with tarfile.open(archive, mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not BACKUP_MEMBER.match(member.name):
+                raise ValueError('unexpected file in backup: {}'.format(
+                    member.name))
+            name = os.path.basename(member.name)
+            directory = os.path.join(
+                data_dir if name.startswith(SNAPSHOT_PREFIX) else txlog_dir,
+                VERSION_DIR)
+            os.makedirs(directory, exist_ok=True)
+            tmp = os.path.join(directory, '.{}.tmp'.format(name))
+            with tar.extractfile(member) as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.chown(tmp, owner.st_uid, owner.st_gid)
+            os.replace(tmp, os.path.join(directory, name))
+            extracted.append(name)
+    for directory in {data_dir, txlog_dir}:
+        os.makedirs(os.path.join(directory, VERSION_DIR), exist_ok=True)
+        _fsync_dir(os.path.join(directory, VERSION_DIR))
+    hookenv.log('Restored {} from {}'.format(', '.join(extracted), archive))
+    return extracted
+
+
+def _percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def fsync_benchmark(directory, count=200, size=4096):
+    '''
+    Measure the latency of the writes of a transaction log in
+    `directory`: `count` sequential writes of `size` bytes, each followed
+    by an fdatasync, to a file preallocated the way Zookeeper
+    preallocates its logs. Returns the p50, p95, p99 and max latencies
+    in milliseconds.
+
+    '''
+    os.makedirs(directory, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=directory, prefix='.fsync-benchmark.')
+    try:
+        zeros = bytes(CHUNK_SIZE)
+        for _ in range(0, count * size, CHUNK_SIZE):
+            os.write(fd, zeros)
+        os.fsync(fd)
+        os.lseek(fd, 0, os.SEEK_SET)
+
+        record = os.urandom(size)
+        latencies = []
+        for _ in range(count):
+            start = time.monotonic()
+            os.write(fd, record)
+            os.fdatasync(fd)
+            latencies.append((time.monotonic() - start) * 1000)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+    latencies.sort()
+    return {
+        'directory': directory,
+        'count': count,
+        'size': size,
+        'p50_ms': round(_percentile(latencies, 50), 3),
+        'p95_ms': round(_percentile(latencies, 95), 3),
+        'p99_ms': round(_percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'time': time.time(),
+    }
+
+
+def disk_usage_percent(directory):
+    '''
+    Return the used space of the filesystem holding `directory`, in
+    percent of the space available to unprivileged users, like df.
+
+    '''
+    st = os.statvfs(directory)
+    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+    total = used + st.f_bavail * st.f_frsize
+    return 100.0 * used / total if total else 0.0
+
+
+def purge_plan(data_dir, txlog_dir=None, retain_count=3, retain_seconds=0,
+               retain_bytes=0, now=None):
+    '''
+    Return the paths of the snapshots and transaction logs to delete,
+    oldest first.
+
+    The newest `retain_count` snapshots are always kept. Older ones are
+    kept as long as they are younger than `retain_seconds`, and as long
+    as the kept snapshots and logs fit in `retain_bytes` (when set), the
+    oldest going first. Like Zookeeper's own purge, the logs older than
+    the oldest kept snapshot are deleted, except for the one holding the
+    transactions right after it.
+
+    '''
+    txlog_dir = txlog_dir or data_dir
+    now = time.time() if now is None else now
+
+    def stat(directory, name):
+        path = os.path.join(directory, VERSION_DIR, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return path, file_zxid(name), st.st_size, st.st_mtime
+
+    snapshots = [s for s in (stat(data_dir, name) for name in
+                             list_files(data_dir, SNAPSHOT_PREFIX)) if s]
+    logs = [s for s in (stat(txlog_dir, name) for name in
+                        list_files(txlog_dir, TXLOG_PREFIX)) if s]
+    if len(snapshots) <= retain_count:
+        return []
+
+    def kept_logs(oldest_zxid):
+        older = [log for log in logs if log[1] <= oldest_zxid]
+        return older[-1:] + [log for log in logs if log[1] > oldest_zxid]
+
+    newest = snapshots[len(snapshots) - retain_count:]
+    extra = [snapshot for snapshot in snapshots[:-retain_count]
+             if now - snapshot[3] < retain_seconds]
+    kept = extra + newest
+    if retain_bytes:
+        while extra and sum(f[2] for f in kept + kept_logs(kept[0][1])) > \
+                retain_bytes:
+            extra.pop(0)
+            kept = extra + newest
+
+    logs_kept = kept_logs(kept[0][1])
+    return [f[0] for f in snapshots if f not in kept] + \
+        [f[0] for f in logs if f not in logs_kept]
+
+
+def throttled_unlink(path, rate=0, step=64 * 1024 * 1024, deadline=None):
+    '''
+    Delete the file at `path`, freeing at most `rate` bytes per second
+    (when set): the file is truncated `step` bytes at a time, and the
+    filesystem frees its blocks a little at a time instead of in one
+    burst of I/O. Returns the number of bytes freed.
+
+    Past the `deadline` (a time.monotonic value), no further step is
+    taken: the file is left in place, partly truncated, for the next
+    purge to finish.
+
+    '''
+    size = os.path.getsize(path)
+    if rate:
+        remaining = size
+        with open(path, 'r+b') as f:
+            while remaining > step:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return size - remaining
+                remaining -= step
+                f.truncate(remaining)
+                time.sleep(step / rate)
+        os.unlink(path)
+        pause = remaining / rate
+        if deadline is not None:
+            pause = min(pause, max(0, deadline - time.monotonic()))
+        time.sleep(pause)
+    else:
+        os.unlink(path)
+    return size
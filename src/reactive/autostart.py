@@ -1,30 +1,62 @@
 from charmhelpers.core import hookenv
 
-from charms.reactive import when
+from charms.reactive import when, is_flag_set
 
 from charms.layer.zookeeper import Zookeeper
 
 
+RESTART_ATTEMPTS = 3
+# Seconds a restarted server gets to bind its ports and join the quorum.
+READY_TIMEOUT = 60
+
+
+def _report_progress(state):
+    if state['running']:
+        hookenv.status_set('maintenance',
+                           'zookeeper is up, waiting to join the quorum')
+    else:
+        hookenv.status_set('maintenance', 'waiting for zookeeper to start')
+
+
 @when('zookeeper.started')
 def autostart_service():
     '''
     Attempt to restart the service if it is not running.
 
+    A server whose process is up but that is not serving yet is given
+    time to join the quorum instead of being restarted. That wait only
+    happens in the hook that (re)started the service; other hooks, like
+    update-status, only probe it once rather than block on a server that
+    stays out of the quorum.
+
     '''
     zookeeper = Zookeeper()
-    if zookeeper.is_running():
-        hookenv.status_set('active',
-                           'ready {}'.format(zookeeper.quorum_check()))
-        return
+    state = zookeeper.probe()
+    wait = zookeeper.started_in_hook()
 
-    for i in range(3):
-        hookenv.status_set('maintenance',
-                           'attempting to restart zookeeper, '
-                           'attempt: {}'.format(i+1))
-        zookeeper.restart()
-        if zookeeper.is_running():
-            hookenv.status_set('active',
-                               'ready {}'.format(zookeeper.quorum_check()))
+    for i in range(RESTART_ATTEMPTS + 1):
+        if state['mode'] is not None:
+            # Keep reporting invalid config options until they are fixed.
+            if not is_flag_set('zookeeper.config.invalid'):
+                hookenv.status_set('active', zookeeper.ready_message())
             return
 
+        if state['running']:
+            if i > 0 or not wait:
+                # Restarting again would only delay the quorum join.
+                hookenv.status_set('waiting',
+                                   'zookeeper is running but not serving '
+                                   'requests yet')
+                return
+        elif i < RESTART_ATTEMPTS:
+            hookenv.status_set('maintenance',
+                               'attempting to restart zookeeper, '
+                               'attempt: {}'.format(i+1))
+            zookeeper.restart()
+        else:
+            break
+
+        state = zookeeper.wait_until_ready(READY_TIMEOUT,
+                                           progress=_report_progress)
+
     hookenv.status_set('blocked', 'failed to start zookeeper; check syslog')
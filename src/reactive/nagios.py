@@ -1,3 +1,4 @@
+import glob
 import os
 import shutil
 
@@ -6,6 +7,15 @@ from charmhelpers.core import hookenv
 from charms.reactive import when, when_not, hook, set_state, remove_state
 
 
+# The one check per metric of earlier revisions, replaced by zk_stats.
+RETIRED_CHECKS = ('zk_open_file_descriptor_coun', 'zk_ephemerals_count',
+                  'zk_avg_latency', 'zk_max_latency', 'zk_min_latency',
+                  'zk_outstanding_requests', 'zk_watch_count')
+# Where the NRPE check and the exported Nagios service of a check live.
+CHECK_FILES = ('/etc/nagios/nrpe.d/check_{}.cfg',
+               '/var/lib/nagios/export/service__*_check_{}.cfg')
+
+
 @when('local-monitors.available')
 def local_monitors_available(nagios):
     setup_nagios(nagios)
@@ -19,59 +29,68 @@ def nrpe_external_master_available(nagios):
 def setup_nagios(nagios):
     config = hookenv.config()
     unit_name = hookenv.local_unit()
+    # All the keys are checked against a single 'mntr' sample, so the
+    # whole set costs one plugin run and one connection to the server.
     checks = [{
-        'name': 'zk_open_file_descriptor_coun',
-        'description': 'ZK_Open_File_Descriptors_Count',
+        'key': 'zk_open_file_descriptor_count',
         'warn': 500,
         'crit': 800,
     }, {
-        'name': 'zk_ephemerals_count',
-        'description': 'ZK_Ephemerals_Count',
+        'key': 'zk_ephemerals_count',
         'warn': 10000,
         'crit': 100000,
     }, {
-        'name': 'zk_avg_latency',
-        'description': 'ZK_Avg_Latency',
+        'key': 'zk_avg_latency',
         'warn': 500,
         'crit': 1000,
     }, {
-        'name': 'zk_max_latency',
-        'description': 'ZK_Max_Latency',
+        'key': 'zk_max_latency',
         'warn': 2000,
         'crit': 3000,
     }, {
-        'name': 'zk_min_latency',
-        'description': 'ZK_Min_Latency',
+        'key': 'zk_min_latency',
         'warn': 500,
         'crit': 1000,
     }, {
-        'name': 'zk_outstanding_requests',
-        'description': 'ZK_Outstanding_Requests',
+        'key': 'zk_outstanding_requests',
         'warn': 20,
         'crit': 50,
     }, {
-        'name': 'zk_watch_count',
-        'description': 'ZK_Watch_Count',
+        'key': 'zk_watch_count',
         'warn': 100,
         'crit': 500,
     }]
     check_cmd = ['/usr/local/lib/nagios/plugins/check_zookeeper.py',
                  '-o', 'nagios',
-                 '-s', '{}:2181'.format(hookenv.unit_private_ip())]
-    for check in checks:
-        nagios.add_check(check_cmd + ['--key', check['name'],
-                                      '-w', str(check['warn']),
-                                      '-c', str(check['crit'])],
-                         name=check['name'],
-                         description=check['description'],
-                         context=config["nagios_context"],
-                         servicegroups=(config.get("nagios_servicegroups")
-                                        or config["nagios_context"]),
-                         unit=unit_name)
+                 '-s', '{}:2181'.format(hookenv.unit_private_ip()),
+                 '--cache-ttl', '10',
+                 '--checks', ','.join('{key}:{warn}:{crit}'.format(**check)
+                                      for check in checks)]
+    nagios.add_check(check_cmd,
+                     name='zk_stats',
+                     description='ZK_Stats',
+                     context=config["nagios_context"],
+                     servicegroups=(config.get("nagios_servicegroups")
+                                    or config["nagios_context"]),
+                     unit=unit_name)
+    remove_retired_checks()
     nagios.updated()
     set_state('zookeeper.nrpe_helper.registered')
 
 
+def remove_retired_checks():
+    '''
+    Remove the checks of earlier revisions, so that upgraded units do not
+    keep running them next to zk_stats.
+
+    '''
+    for name in RETIRED_CHECKS:
+        for pattern in CHECK_FILES:
+            for path in glob.glob(pattern.format(name)):
+                hookenv.log('Removing retired check {}'.format(path))
+                os.remove(path)
+
+
 @hook('upgrade-charm')
 def nrpe_helper_upgrade_charm():
     # Make sure the nrpe handler will get replaced at charm upgrade
@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+
+from charmhelpers.core import hookenv, host, unitdata
+from charmhelpers.core.templating import render
+
+from charms.reactive import when, when_not, hook, set_flag, clear_flag
+
+from charms.layer.zookeeper import ZK_PORT, prometheus_port
+
+
+EXPORTER_SERVICE = 'zookeeper-exporter'
+EXPORTER_UNIT = '/etc/systemd/system/{}.service'.format(EXPORTER_SERVICE)
+EXPORTER_SCRIPT = '/usr/local/lib/zookeeper/check_zookeeper.py'
+
+
+@hook('config-changed', 'upgrade-charm')
+def prometheus_config_changed():
+    # Re-render the exporter, and pick up a new check script on upgrade.
+    clear_flag('zookeeper.prometheus.configured')
+
+
+@when('zookeeper.started')
+@when_not('zookeeper.prometheus.configured')
+def configure_prometheus_exporter():
+    '''
+    Run check_zookeeper.py in Prometheus serve mode when a port is
+    configured, and stop it otherwise.
+
+    '''
+    kv = unitdata.kv()
+    try:
+        port = prometheus_port(hookenv.config())
+    except ValueError:
+        # configure reports the invalid option; keep the exporter as it
+        # is until it is fixed.
+        return
+    old_port = kv.get('zookeeper.prometheus.port')
+
+    if old_port and int(old_port) != port:
+        hookenv.close_port(int(old_port))
+
+    if not port:
+        if os.path.exists(EXPORTER_UNIT):
+            host.service_stop(EXPORTER_SERVICE)
+            host.service('disable', EXPORTER_SERVICE)
+            os.remove(EXPORTER_UNIT)
+            subprocess.check_call(['systemctl', 'daemon-reload'])
+        kv.unset('zookeeper.prometheus.port')
+        set_flag('zookeeper.prometheus.configured')
+        return
+
+    os.makedirs(os.path.dirname(EXPORTER_SCRIPT), exist_ok=True)
+    shutil.copy('{}/files/check_zookeeper.py'.format(hookenv.charm_dir()),
+                EXPORTER_SCRIPT)
+    os.chmod(EXPORTER_SCRIPT, 0o755)
+
+    render(
+        source='zookeeper-exporter.service',
+        target=EXPORTER_UNIT,
+        owner='root',
+        perms=0o644,
+        context={
+            'script': EXPORTER_SCRIPT,
+            'server': '{}:{}'.format(hookenv.unit_private_ip(), ZK_PORT),
+            'port': port,
+        }
+    )
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    host.service('enable', EXPORTER_SERVICE)
+    host.service_restart(EXPORTER_SERVICE)
+    hookenv.open_port(port)
+    kv.set('zookeeper.prometheus.port', port)
+    set_flag('zookeeper.prometheus.configured')
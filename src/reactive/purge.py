@@ -0,0 +1,27 @@
+import time
+
+from charmhelpers.core import hookenv
+
+from charms.reactive import hook, is_flag_set
+
+from charms.layer.zookeeper import Zookeeper
+
+
+# Longest time a purge may hold the update-status hook; whatever is left
+# is purged on the next one.
+PURGE_HOOK_SECONDS = 120
+
+
+@hook('update-status')
+def scheduled_purge():
+    '''
+    Run the charm purge engine when it is due.
+
+    '''
+    if not is_flag_set('zookeeper.started') or \
+            hookenv.config().get('purge_mode') != 'charm':
+        return
+    try:
+        Zookeeper().purge(deadline=time.monotonic() + PURGE_HOOK_SECONDS)
+    except ValueError as e:
+        hookenv.log('Not purging: {}'.format(e), level='WARN')
@@ -4,7 +4,35 @@ from charmhelpers.core import hookenv, unitdata
 
 from charms.reactive import hook, set_flag, clear_flag
 
-from charms.layer.zookeeper import Zookeeper
+from charms.layer.zookeeper import Zookeeper, APP_DATADIR
+from charms.layer.zookeeper_storage import (
+    VERSION_DIR, move_txlogs, sync_data)
+
+
+def _migrate_data(zookeeper, src_dir, dst_dir):
+    '''
+    Stop Zookeeper, with its data moved from `src_dir` to `dst_dir` so
+    that it resumes from the same zxid instead of resyncing everything
+    from the leader.
+
+    The bulk of the data is copied while the server runs, and only the
+    files that changed since (the current transaction log, new
+    snapshots) are copied again once it is stopped.
+
+    '''
+    if not os.path.isdir(os.path.join(src_dir, VERSION_DIR)) or \
+            os.path.realpath(src_dir) == os.path.realpath(dst_dir):
+        zookeeper.close_ports()
+        zookeeper.stop()
+        return
+
+    hookenv.status_set('maintenance', 'copying data to {}'.format(dst_dir))
+    copied = sync_data(src_dir, dst_dir)
+    zookeeper.close_ports()
+    zookeeper.stop()
+    copied = sync_data(src_dir, dst_dir, copied)
+    hookenv.log('Copied {} files from {} to {}'.format(
+        len(copied), src_dir, dst_dir))
 
 
 @hook('data-storage-attached')
@@ -21,13 +49,16 @@ def storage_attach():
         return
 
     data_dir = os.path.join(mount, "data")
-    unitdata.kv().set('zookeeper.storage.data_dir', data_dir)
-    hookenv.log('Zookeeper data storage attached at {}'.format(data_dir))
-    # Stop Zookeeper; removing zookeeper.configured state will trigger
-    # a reconfigure if/when it's ready
+    kv = unitdata.kv()
+    # Stop Zookeeper once its data is on the attached storage; removing
+    # zookeeper.configured state will trigger a reconfigure if/when it's
+    # ready
     zookeeper = Zookeeper()
-    zookeeper.close_ports()
-    zookeeper.stop()
+    _migrate_data(zookeeper,
+                  kv.get('zookeeper.storage.data_dir', APP_DATADIR), data_dir)
+    kv.set('zookeeper.storage.data_dir', data_dir)
+    hookenv.log('Zookeeper data storage attached at {}'.format(data_dir))
+    zookeeper.benchmark_storage()
     clear_flag('zookeeper.configured')
     hookenv.status_set('waiting', 'reconfiguring to use attached storage')
     set_flag('zookeeper.storage.data.attached')
@@ -35,10 +66,69 @@ def storage_attach():
 
 @hook('data-storage-detaching')
 def storage_detaching():
-    unitdata.kv().unset('zookeeper.storage.data_dir')
+    kv = unitdata.kv()
     zookeeper = Zookeeper()
-    zookeeper.close_ports()
-    zookeeper.stop()
+    _migrate_data(zookeeper,
+                  kv.get('zookeeper.storage.data_dir', APP_DATADIR),
+                  APP_DATADIR)
+    kv.unset('zookeeper.storage.data_dir')
     clear_flag('zookeeper.configured')
     hookenv.status_set('waiting', 'reconfiguring to use temporary storage')
     clear_flag('zookeeper.storage.data.attached')
+
+
+def _txlog_dir():
+    '''
+    Return the directory currently holding the transaction logs.
+
+    '''
+    kv = unitdata.kv()
+    return (kv.get('zookeeper.storage.txlog_dir') or
+            kv.get('zookeeper.storage.data_dir') or APP_DATADIR)
+
+
+@hook('txlog-storage-attached')
+def txlog_storage_attach():
+    storageids = hookenv.storage_list('txlog')
+    if not storageids:
+        hookenv.status_set('blocked', 'cannot locate attached txlog storage')
+        return
+    storageid = storageids[0]
+
+    mount = hookenv.storage_get('location', storageid)
+    if not mount:
+        hookenv.status_set('blocked',
+                           'cannot locate attached txlog storage mount')
+        return
+
+    txlog_dir = os.path.join(mount, "txlog")
+    # Stop Zookeeper while the existing logs are moved over, so that the
+    # server resumes from the same transactions once reconfigured.
+    zookeeper = Zookeeper()
+    zookeeper.close_ports()
+    zookeeper.stop()
+    hookenv.status_set('maintenance', 'moving transaction logs')
+    move_txlogs(_txlog_dir(), txlog_dir)
+    unitdata.kv().set('zookeeper.storage.txlog_dir', txlog_dir)
+    hookenv.log('Zookeeper txlog storage attached at {}'.format(txlog_dir))
+    zookeeper.benchmark_storage()
+    clear_flag('zookeeper.configured')
+    hookenv.status_set('waiting',
+                       'reconfiguring to use attached txlog storage')
+    set_flag('zookeeper.storage.txlog.attached')
+
+
+@hook('txlog-storage-detaching')
+def txlog_storage_detaching():
+    zookeeper = Zookeeper()
+    zookeeper.close_ports()
+    zookeeper.stop()
+    hookenv.status_set('maintenance', 'moving transaction logs')
+    kv = unitdata.kv()
+    move_txlogs(_txlog_dir(), kv.get('zookeeper.storage.data_dir') or
+                APP_DATADIR)
+    kv.unset('zookeeper.storage.txlog_dir')
+    clear_flag('zookeeper.configured')
+    hookenv.status_set('waiting', 'reconfiguring to keep transaction logs '
+                                  'with the data')
+    clear_flag('zookeeper.storage.txlog.attached')
@@ -1,7 +1,7 @@
 import json
 import time
 
-from charmhelpers.core import hookenv, unitdata
+from charmhelpers.core import hookenv, host, unitdata
 
 from charms.reactive import (when, when_not, set_flag, hook,
                              clear_flag, is_state, is_flag_set)
@@ -10,11 +10,16 @@ from charms.reactive.helpers import data_changed
 from charms import apt
 
 from charms.layer.zookeeper import (
-    APP_NAME, Zookeeper, ZK_PORT, ZK_REST_PORT)
+    APP_NAME, Zookeeper, ZK_PORT, ZK_REST_PORT, is_observer, prometheus_port)
+from charms.layer.zookeeper_profiling import instrument_handlers
 
 from charms.leadership import leader_set, leader_get
 
 
+# Time the handlers of this hook when the profiling option is set.
+instrument_handlers()
+
+
 @hook('config-changed')
 def config_changed():
     # Remove configured flag to trigger reconfig.
@@ -26,24 +31,70 @@ def config_changed():
 def configure():
     cfg = hookenv.config()
     zookeeper = Zookeeper()
+    # A new "auto" tunable restarts the server. A lone server has no
+    # quorum to keep, and takes it right away; members of an ensemble take
+    # it in a rolling restart (see check_auto_tunables).
+    refresh = not is_flag_set('zkpeer.joined')
+    try:
+        tunables = zookeeper.tunables(refresh)
+        zookeeper.purge_settings()
+        prometheus_port(cfg)
+    except ValueError as e:
+        hookenv.status_set('blocked', str(e))
+        set_flag('zookeeper.config.invalid')
+        return
+    clear_flag('zookeeper.config.invalid')
+    if cfg.get('hold_first_start') and \
+            not is_flag_set('zookeeper.started') and \
+            not unitdata.kv().get('zookeeper.seeded'):
+        hookenv.status_set('blocked', 'waiting for the seed action '
+                           '(hold_first_start)')
+        return
+    if not is_flag_set('zookeeper.started') and \
+            leader_get('ensemble') and not is_flag_set('zkpeer.joined'):
+        # Joining a running ensemble: started before its peers are known,
+        # the server would form an ensemble of its own.
+        hookenv.status_set('waiting', 'waiting for the peers of the '
+                           'ensemble')
+        return
+    if not zookeeper.storage_benchmarked():
+        zookeeper.benchmark_storage()
+    # check_cluster tracks the peers under zkpeer.nodes on the leader.
+    peers_changed = data_changed('zk.peers', zookeeper.read_peers())
+    secret_changed = False
+    if zookeeper.supports_reconfig():
+        secret_changed = data_changed('zk.reconfig_secret',
+                                      leader_get('reconfig_secret'))
+        if is_flag_set('zookeeper.started'):
+            # The leader applies membership changes with reconfig, or
+            # falls back to a rolling restart; see check_cluster.
+            peers_changed = False
     changed = any((
-        data_changed('zkpeer.nodes', zookeeper.read_peers()),
+        peers_changed,
+        secret_changed,
         data_changed('zk.autopurge_purge_interval',
                      cfg.get('autopurge_purge_interval')),
         data_changed('zk.autopurge_snap_retain_count',
                      cfg.get('autopurge_snap_retain_count')),
         data_changed('zk.storage.data_dir',
                      unitdata.kv().get('zookeeper.storage.data_dir')),
+        data_changed('zk.storage.txlog_dir',
+                     unitdata.kv().get('zookeeper.storage.txlog_dir')),
         data_changed('zk.jmx_port',
                      cfg.get('jmx_port')),
+        data_changed('zk.jvm', (cfg.get('heap_size'),
+                                cfg.get('gc_collector'),
+                                cfg.get('gc_logging'))),
+        data_changed('zk.tunables', tunables),
+        data_changed('zk.purge_mode', cfg.get('purge_mode')),
     ))
     if changed or is_flag_set('zookeeper.force-reconfigure'):
-        zookeeper.install()
+        zookeeper.install(refresh_tunables=refresh)
         zookeeper.open_ports()
     clear_flag('zookeeper.force-reconfigure')
     set_flag('zookeeper.started')
     set_flag('zookeeper.configured')
-    hookenv.status_set('active', 'ready {}'.format(zookeeper.quorum_check()))
+    hookenv.status_set('active', zookeeper.ready_message())
     # set app version string for juju status output
     zoo_version = apt.get_package_version(APP_NAME) or 'unknown'
     hookenv.application_version_set(zoo_version)
@@ -53,11 +104,21 @@ def _restart_zookeeper(msg):
     '''
     Restart Zookeeper by re-running the puppet scripts.
 
+    Returns once the server serves requests again (or gave up waiting),
+    so that a rolling restart does not take down the next batch of nodes
+    while this one is still rejoining the quorum. Returns whether it
+    does.
+
     '''
     hookenv.status_set('maintenance', msg)
     zookeeper = Zookeeper()
-    zookeeper.install()
-    hookenv.status_set('active', 'ready {}'.format(zookeeper.quorum_check()))
+    zookeeper.install(reset_membership=True, refresh_tunables=True)
+    if zookeeper.wait_until_ready()['mode'] is None:
+        hookenv.status_set('waiting', 'restarted, waiting to rejoin the '
+                           'quorum')
+        return False
+    hookenv.status_set('active', zookeeper.ready_message())
+    return True
 
 
 @when('zookeeper.started', 'zookeeper.joined')
@@ -85,26 +146,36 @@ def serve_client(client):
 #
 # 1. When a node is added or remove from the cluster, the Juju leader
 #    runs `check_cluster`, and generates a "restart queue" comprising
-#    nodes in the cluster, with the Zookeeper lead node sorted last in
-#    the queue. It also sets a nonce, to identify this restart queue
-#    uniquely, and thus handle the situation where another node is
-#    added or restarted while we're still reacting to the first node's
-#    addition or removal. The leader drops the queue and nonce into
-#    the leadership data as "restart_queue" and "restart_nonce",
-#    respectively.
+#    batches of nodes in the cluster, with the Zookeeper lead node alone
+#    in the last batch. Each batch holds at most as many nodes as the
+#    ensemble can lose while keeping a majority up, so that quorum is
+#    preserved while a batch restarts: the nodes that are already down
+#    count against that, and while the membership changes, so does the
+#    smaller of the old and new voting ensembles. Observers do not vote,
+#    so they all restart together, in the first batch. It also sets a
+#    nonce, to identify this restart queue uniquely, and thus handle the
+#    situation where another node is added or restarted while we're
+#    still reacting to the first node's addition or removal. The
+#    leader drops the queue and nonce into the leadership data as
+#    "restart_queue" and "restart_nonce", respectively.
 #
 # 2. When any node detects a leadership.changed.restart_queue event,
 #    it runs `restart_for_quorum`, which is a noop unless the node's
-#    private address is the first element of the restart queue. In
-#    that case, if the node is the Juju leader, it will restart, then
-#    remove itself from the restart queue, triggering another
-#    leadership.changed.restart_queue event. If the node isn't the
-#    Juju leader, it will restart itself, then run `inform_restart`.
+#    private address is in the first batch of the restart queue, and it
+#    has not restarted for this nonce yet. In that case, it restarts
+#    and waits until it serves requests again. If the node is the Juju
+#    leader, it then removes itself from the restart queue, triggering
+#    another leadership.changed.restart_queue event. If the node isn't
+#    the Juju leader, it runs `inform_restart`. A node that is not
+#    serving requests yet when it gives up waiting does neither, and
+#    leaves that to `report_restart`, in a later hook, once it serves
+#    requests: the next batch must not restart before.
 #
 # 3. `inform_restart` will create a relation data changed event, which
 #    triggers `update_restart_queue` to run on the leader. This method
 #    will update the restart_queue, clearing any nodes that have
-#    restarted for the current nonce, and looping us back to step 2.
+#    restarted for the current nonce, and dropping the batches that
+#    are done, looping us back to step 2.
 #
 # 4. Once all the nodes have restarted, we should be in the following state:
 #
@@ -118,6 +189,17 @@ def serve_client(client):
 #      data. This is okay, as we will generate a new nonce next time,
 #      and the data is small.
 #
+# The rolling restart is also where the nodes derive the "auto" tunables
+# (initLimit, maxClientCnxns) again: the Juju leader runs
+# `check_auto_tunables`, and queues a rolling restart when they no longer
+# match the ones the servers run with.
+#
+# On Zookeeper 3.5 and later, the Juju leader first tries to apply the
+# membership change to the running ensemble with `reconfig`, adding and
+# removing servers in the dynamic config file, which needs no restart
+# at all. The rolling restart above is only used when that is not
+# possible.
+#
 # Edge cases and potential bugs:
 #
 # 1. Juju leader changes in the middle of a restart: this gets a
@@ -147,23 +229,136 @@ def _ip_list(nodes):
     return [node[1].split(':')[0] for node in nodes]
 
 
+def _restart_batches(peers, leader, observers=(), voters=None, down=()):
+    '''
+    Given the ips of the peers, the ip of the Zookeeper leader (which
+    may be None) and the ips of the observers among the peers, split
+    them into batches that can be restarted at the same time without
+    losing quorum. The observers come first, all together, and the
+    leader comes alone, last.
+
+    An ensemble of n voting nodes keeps a majority with (n - 1) // 2
+    nodes down, so the followers are restarted in batches of that size,
+    less the voting nodes in `down` (ips of the nodes not serving
+    requests), and at least one node. `voters` is the number of voting
+    nodes the quorum is counted from (the voting peers by default): the
+    smaller of the old and new ensembles while the membership changes.
+
+    '''
+    batches = []
+    observers = [peer for peer in peers if peer in observers]
+    if observers:
+        batches.append(observers)
+    participants = [peer for peer in peers if peer not in observers]
+    if voters is None:
+        voters = len(participants)
+    down = [peer for peer in down if peer not in observers]
+    size = max(1, (voters - 1) // 2 - len(down))
+    followers = [peer for peer in participants if peer != leader]
+    batches.extend(followers[i:i + size]
+                   for i in range(0, len(followers), size))
+    if leader in participants:
+        batches.append([leader])
+    return batches
+
+
+def _load_restart_queue():
+    '''
+    Read the restart queue from the leadership data, as a list of
+    batches. Single ips, as queued by older revisions of this charm,
+    are read as batches of one.
+
+    '''
+    queue = json.loads(leader_get('restart_queue') or '[]')
+    return [batch if isinstance(batch, list) else [batch]
+            for batch in queue]
+
+
+@when('leadership.is_leader')
+@when_not('leadership.set.reconfig_secret')
+def generate_reconfig_secret():
+    '''
+    Generate the password of the Zookeeper super user, which the leader
+    uses to run dynamic reconfigurations.
+
+    '''
+    leader_set(reconfig_secret=host.pwgen(32))
+
+
 @when('zookeeper.started', 'leadership.is_leader', 'zkpeer.joined')
 @when_not('zkpeer.departed')
 def check_cluster(zkpeer):
     '''
-    Checkup on the state of the cluster. Start a rolling restart if
-    the peers have changed.
+    Checkup on the state of the cluster. Apply the new membership with
+    dynamic reconfiguration if the peers have changed, or start a
+    rolling restart if that is not supported or fails.
+
+    '''
+    zk = Zookeeper()
+    peers = zk.read_peers()
+    if data_changed('zkpeer.nodes', peers):
+        previous = [tuple(node) for node in
+                    json.loads(leader_get('ensemble') or '[]')]
+        leader_set(ensemble=json.dumps(peers))
+        if previous and zk.supports_reconfig():
+            joining = [node for node in peers if node not in previous]
+            # A node changing role is re-added with its new spec, which
+            # replaces the old one.
+            leaving = [node for node in previous if node not in peers and
+                       node[0] not in [n[0] for n in joining]]
+            if zk.reconfig(joining, leaving):
+                hookenv.log('Quorum changed. Reconfigured ensemble: '
+                            'added {}, removed {}'.format(joining, leaving))
+                return
+
+        _queue_rolling_restart(zk, zkpeer, 'Quorum changed', previous)
+
+
+def _queue_rolling_restart(zk, zkpeer, reason, previous=()):
+    '''
+    Queue a rolling restart of the ensemble, as batches of nodes, under a
+    new nonce. `previous` is the ensemble before a membership change.
 
     '''
+    peers = zk.read_peers()
+    leader = zkpeer.find_zk_leader()
+    leader = leader.split(':')[0] if leader else None
+    observers = _ip_list([node for node in peers if is_observer(node)])
+    voters = len([node for node in peers if not is_observer(node)])
+    if previous:
+        voters = min(voters, len([node for node in previous
+                                  if not is_observer(node)]))
+    ips = _ip_list(zk.sort_peers(zkpeer))
+    queue = _restart_batches(ips, leader, observers, voters,
+                             zk.down_peers(ips))
+    nonce = time.time()
+    hookenv.log('{}. Restart queue: {}'.format(reason, queue))
+    leader_set(
+        restart_queue=json.dumps(queue),
+        restart_nonce=json.dumps(nonce)
+    )
+
+
+@when('zookeeper.started', 'leadership.is_leader', 'zkpeer.joined')
+@when_not('zookeeper.config.invalid')
+def check_auto_tunables(zkpeer):
+    '''
+    Queue a rolling restart when the values derived for the "auto"
+    tunables no longer match the ones the servers run with, unless one is
+    already under way: the nodes only take new values as they restart in
+    turn.
+
+    '''
+    if _load_restart_queue():
+        return
     zk = Zookeeper()
-    if data_changed('zkpeer.nodes', zk.read_peers()):
-        peers = _ip_list(zk.sort_peers(zkpeer))
-        nonce = time.time()
-        hookenv.log('Quorum changed. Restart queue: {}'.format(peers))
-        leader_set(
-            restart_queue=json.dumps(peers),
-            restart_nonce=json.dumps(nonce)
-        )
+    try:
+        changed = zk.auto_tunables_changed()
+    except ValueError:
+        # configure reports the invalid option.
+        return
+    if changed:
+        _queue_rolling_restart(zk, zkpeer, 'Automatic tunables changed')
 
 
 @when('zookeeper.started', 'leadership.is_leader', 'zkpeer.joined',
@@ -200,21 +395,65 @@ def restart_for_quorum(zkpeer):
 
     '''
     private_address = hookenv.unit_get('private-address')
-    queue = json.loads(leader_get('restart_queue') or '[]')
+    queue = _load_restart_queue()
 
     if not queue:
         # Everything has restarted.
         return
 
-    if private_address == queue[0]:
-        # It's our turn to restart.
-        _restart_zookeeper('rolling restart for quorum update')
-        if is_state('leadership.is_leader'):
-            queue = queue[1:]
-            hookenv.log('Leader updating restart queue: {}'.format(queue))
-            leader_set(restart_queue=json.dumps(queue))
+    nonce = leader_get('restart_nonce')
+    kv = unitdata.kv()
+    if private_address in queue[0] and \
+            kv.get('zookeeper.restart_nonce') != nonce and \
+            kv.get('zookeeper.restart_pending') != nonce:
+        # It's our turn to restart, along with the rest of our batch.
+        if _restart_zookeeper('rolling restart for quorum update'):
+            _report_restart(zkpeer, nonce)
         else:
-            zkpeer.inform_restart()
+            hookenv.log('Restarted, but not serving requests yet; the '
+                        'restart queue waits until it does.')
+            kv.set('zookeeper.restart_pending', nonce)
+            set_flag('zookeeper.restart.pending')
+
+
+@when('zookeeper.restart.pending', 'zkpeer.joined')
+def report_restart(zkpeer):
+    '''
+    Report a restart of the rolling restart once the server serves
+    requests, if it did not yet when restart_for_quorum gave up waiting.
+
+    '''
+    nonce = leader_get('restart_nonce')
+    if unitdata.kv().get('zookeeper.restart_pending') != nonce:
+        # A new restart queue replaced that one.
+        clear_flag('zookeeper.restart.pending')
+        return
+
+    zookeeper = Zookeeper()
+    if zookeeper.probe()['mode'] is None:
+        return
+    hookenv.status_set('active', zookeeper.ready_message())
+    _report_restart(zkpeer, nonce)
+
+
+def _report_restart(zkpeer, nonce):
+    '''
+    Record that this node restarted, and serves requests, for the restart
+    queue `nonce`: the leader removes itself from the queue, other nodes
+    inform the leader.
+
+    '''
+    unitdata.kv().set('zookeeper.restart_nonce', nonce)
+    clear_flag('zookeeper.restart.pending')
+    if is_state('leadership.is_leader'):
+        private_address = hookenv.unit_get('private-address')
+        queue = [[node for node in batch if node != private_address]
+                 for batch in _load_restart_queue()]
+        queue = [batch for batch in queue if batch]
+        hookenv.log('Leader updating restart queue: {}'.format(queue))
+        leader_set(restart_queue=json.dumps(queue))
+    else:
+        zkpeer.inform_restart()
 
 
 @when('leadership.is_leader', 'zkpeer.joined')
@@ -224,13 +463,15 @@ def update_restart_queue(zkpeer):
     pop it off of the queue.
 
     '''
-    queue = json.loads(leader_get('restart_queue') or '[]')
+    queue = _load_restart_queue()
     if not queue:
         return
 
     restarted_nodes = _ip_list(zkpeer.restarted_nodes())
-    new_queue = [node for node in queue if node not in restarted_nodes]
+    new_queue = [[node for node in batch if node not in restarted_nodes]
+                 for batch in queue]
+    new_queue = [batch for batch in new_queue if batch]
 
     if new_queue != queue:
-        hookenv.log('Leader updating restart queue: {}'.format(queue))
+        hookenv.log('Leader updating restart queue: {}'.format(new_queue))
         leader_set(restart_queue=json.dumps(new_queue))
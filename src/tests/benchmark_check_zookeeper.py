@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+"""
+Benchmarks for files/check_zookeeper.py, run against local FakeZooKeeper
+servers. Results are printed as JSON and can be compared with a previous
+run to catch regressions:
+
+    ./benchmark_check_zookeeper.py --output new.json --baseline old.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'files'))
+sys.path.insert(0, HERE)
+
+import check_zookeeper  # noqa: E402
+from fake_zookeeper import FakeZooKeeper  # noqa: E402
+
+
+def measure(func, repeat):
+    '''
+    Call func `repeat` times and return its latency distribution in
+    milliseconds along with its throughput.
+
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+
+    def percentile(p):
+        return round(timings[min(len(timings) - 1,
+                                 int(len(timings) * p / 100))], 4)
+
+    total = sum(timings)
+    return {
+        'runs': repeat,
+        'mean_ms': round(total / repeat, 4),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': round(timings[-1], 4),
+        'ops_per_sec': round(repeat * 1000 / total, 2) if total else None,
+    }
+
+
+def legacy_parse_stat(data):
+    '''
+    The 'stat' parser of the baseline check_zookeeper.py, copied as it
+    was (bar the raw string prefixes, and the hourly 'srst' reset that
+    it ran after parsing), as the reference the current parser is
+    measured against.
+
+    '''
+    h = io.StringIO(data.decode('utf-8'))
+
+    result = {}
+
+    version = h.readline()
+    if version:
+        result['zk_version'] = version[version.index(':')+1:].strip()
+
+    # skip all lines until we find the empty one
+    while h.readline().strip():
+        pass
+
+    for line in h.readlines():
+        m = re.match(r'Latency min/avg/max: (\d+)/(\d+)/(\d+)', line)
+        if m is not None:
+            result['zk_min_latency'] = int(m.group(1))
+            result['zk_avg_latency'] = int(m.group(2))
+            result['zk_max_latency'] = int(m.group(3))
+            continue
+
+        m = re.match(r'Received: (\d+)', line)
+        if m is not None:
+            result['zk_packets_received'] = int(m.group(1))
+            continue
+
+        m = re.match(r'Sent: (\d+)', line)
+        if m is not None:
+            result['zk_packets_sent'] = int(m.group(1))
+            continue
+
+        m = re.match(r'Outstanding: (\d+)', line)
+        if m is not None:
+            result['zk_outstanding_requests'] = int(m.group(1))
+            continue
+
+        m = re.match('Mode: (.*)', line)
+        if m is not None:
+            result['zk_server_state'] = m.group(1)
+            continue
+
+        m = re.match(r'Node count: (\d+)', line)
+        if m is not None:
+            result['zk_znode_count'] = int(m.group(1))
+            continue
+
+    return result
+
+
+def bench_parsers(repeat, sizes):
+    zk = check_zookeeper.ZooKeeperServer('127.0.0.1', 2181)
+    results = {}
+    for size in sizes:
+        fake = FakeZooKeeper(clients=size, extra_keys=size)
+        mntr = fake.mntr().encode()
+        stat = fake.stat().encode()
+        results['_parse/%d_keys' % size] = measure(
+            lambda: zk._parse(mntr), repeat)
+        results['_parse_stat/%d_clients' % size] = measure(
+            lambda: zk._parse_stat(stat), repeat)
+        results['_parse_stat_legacy/%d_clients' % size] = measure(
+            lambda: legacy_parse_stat(stat), repeat)
+
+        # the whole 'stat' fallback, socket included: streamed, skipping
+        # the client list as it arrives, against read whole then parsed
+        fake.start()
+        try:
+            server = check_zookeeper.ZooKeeperServer(
+                '127.0.0.1', fake.port, persist=False)
+            results['stat_fallback/%d_clients' % size] = measure(
+                lambda: server._parse_stat(server._send_cmd_lines(
+                    'stat', skip=b'Clients:\n')), repeat)
+            results['stat_fallback_legacy/%d_clients' % size] = measure(
+                lambda: legacy_parse_stat(server._send_cmd('stat')), repeat)
+        finally:
+            fake.stop()
+    return results
+
+
+def bench_cluster(repeat, counts, latency, timeout):
+    results = {}
+    scenarios = (
+        ('healthy', 0, 0),
+        ('slow', 0.25, 0),
+        ('dead', 0, 0.25),
+    )
+    for count in counts:
+        for name, slow_ratio, dead_ratio in scenarios:
+            slow = int(count * slow_ratio)
+            dead = int(count * dead_ratio)
+            servers = []
+            for i in range(count):
+                servers.append(FakeZooKeeper(
+                    mode='leader' if i == 0 else 'follower',
+                    latency=latency * (10 if i < slow else 1),
+                    dead=slow <= i < slow + dead).start())
+
+            addresses = [('127.0.0.1', str(s.port)) for s in servers]
+            try:
+                results['get_cluster_stats/%d_servers/%s' % (
+                    count, name)] = measure(
+                    lambda: check_zookeeper.get_cluster_stats(
+                        addresses, timeout), repeat)
+            finally:
+                for server in servers:
+                    server.stop()
+    return results
+
+
+class _Options(object):
+    def __init__(self, servers, **kwargs):
+        self.servers = servers
+        self.key = 'zk_avg_latency'
+        self.warning = '500'
+        self.critical = '1000'
+        self.checks = None
+        self.leader = None
+        self.gmetric = '/bin/true'
+        self.listen = None
+        self.__dict__.update(kwargs)
+
+
+class _QuietGangliaHandler(check_zookeeper.GangliaHandler):
+    def call(self, *args, **kwargs):
+        pass
+
+
+def bench_handlers(repeat, counts):
+    zk = check_zookeeper.ZooKeeperServer('127.0.0.1', 2181)
+    stats = zk._parse(FakeZooKeeper().mntr().encode())
+    results = {}
+    for count in counts:
+        servers = [('10.0.0.%d' % i, '2181') for i in range(count)]
+        cluster_stats = dict(('%s:%s' % s, dict(stats)) for s in servers)
+        handlers = (
+            ('nagios', check_zookeeper.NagiosHandler(), {}),
+            ('nagios_multi', check_zookeeper.NagiosHandler(), {
+                'checks': 'zk_avg_latency:500:1000,zk_max_latency:2000:3000,'
+                          'zk_outstanding_requests:20:50,'
+                          'zk_watch_count:100:500'}),
+            ('cacti', check_zookeeper.CactiHandler(), {}),
+            ('prometheus', check_zookeeper.PrometheusHandler(), {}),
+        )
+        if count == 1:
+            handlers += (('ganglia', _QuietGangliaHandler(), {}),)
+
+        for name, handler, options in handlers:
+            opts = _Options(servers, **options)
+
+            def run():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    handler.analyze(opts, cluster_stats)
+
+            results['handler/%s/%d_servers' % (name, count)] = measure(
+                run, repeat)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the benchmarks whose p95 latency grew by more than `tolerance`
+    (a ratio) compared to the baseline.
+
+    '''
+    regressions = {}
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old or not old.get('p95_ms'):
+            continue
+        ratio = result['p95_ms'] / old['p95_ms']
+        if ratio > 1 + tolerance:
+            regressions[name] = round(ratio, 2)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--servers', type=int, nargs='+',
+                        default=[1, 3, 7, 25, 100])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 1000, 10000])
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='per-request latency of the fake servers')
+    parser.add_argument('--timeout', type=float, default=2.0,
+                        help='deadline passed to get_cluster_stats')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare with the results of a previous run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p95 growth over the baseline')
+    args = parser.parse_args()
+
+    meta_dir = tempfile.mkdtemp(prefix='zk_bench')
+    check_zookeeper.META_DIR = meta_dir
+    try:
+        results = {}
+        results.update(bench_parsers(args.repeat, args.sizes))
+        results.update(bench_handlers(args.repeat, args.servers))
+        results.update(bench_cluster(args.repeat, args.servers,
+                                     args.latency, args.timeout))
+    finally:
+        shutil.rmtree(meta_dir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressions (p95 ratio): {}'.format(
+                json.dumps(regressions, sort_keys=True)), file=sys.stderr)
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
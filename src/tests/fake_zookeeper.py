@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+"""
+Local stand-in for a ZooKeeper server that answers the four letter word
+commands used by check_zookeeper.py. Response sizes and latency are
+configurable, and a server can be made slow or dead (accepting
+connections but never answering), so that the monitoring code can be
+exercised without a real ensemble.
+"""
+
+import socket
+import socketserver
+import threading
+import time
+
+
+class FakeZooKeeper(object):
+
+    def __init__(self, port=0, mode='follower', latency=0.0, dead=False,
+                 clients=1, extra_keys=0, mntr=True):
+        self.mode = mode
+        self.latency = latency
+        self.dead = dead
+        self.clients = clients
+        self.extra_keys = extra_keys
+        self.mntr_enabled = mntr
+        self.received = 0
+        self.resets = 0
+
+        fake = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def handle(self):
+                fake._handle(self.request)
+
+        self._server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', port), Handler, bind_and_activate=False)
+        self._server.daemon_threads = True
+        self._server.allow_reuse_address = True
+        self._server.request_queue_size = 128
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handle(self, sock):
+        cmd = sock.recv(4).decode()
+        if self.dead:
+            # hold the connection open until the client gives up
+            sock.settimeout(30)
+            try:
+                sock.recv(1)
+            except socket.error:
+                pass
+            return
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        self.received += 1
+        response = {
+            'mntr': self.mntr,
+            'stat': self.stat,
+            'srvr': self.srvr,
+            'cons': self.cons,
+            'wchs': self.wchs,
+            'conf': self.conf,
+            'ruok': lambda: 'imok',
+            'srst': self.srst,
+        }.get(cmd, lambda: '')()
+        sock.sendall(response.encode())
+
+    def mntr(self):
+        if not self.mntr_enabled:
+            return ''
+
+        lines = [
+            ('zk_version', '3.4.10-39d3a4f269333c922ed3db283be479f9deacaa0f, '
+                           'built on 03/23/2017 10:13 GMT'),
+            ('zk_avg_latency', 1),
+            ('zk_max_latency', 250),
+            ('zk_min_latency', 0),
+            ('zk_packets_received', self.received * 10),
+            ('zk_packets_sent', self.received * 10),
+            ('zk_num_alive_connections', self.clients),
+            ('zk_outstanding_requests', 0),
+            ('zk_server_state', self.mode),
+            ('zk_znode_count', 1000),
+            ('zk_watch_count', 200),
+            ('zk_ephemerals_count', 20),
+            ('zk_approximate_data_size', 123456),
+            ('zk_open_file_descriptor_count', 40),
+            ('zk_max_file_descriptor_count', 4096),
+        ]
+        if self.mode == 'leader':
+            lines += [('zk_followers', 2), ('zk_synced_followers', 2),
+                      ('zk_pending_syncs', 0)]
+        lines += [('zk_extra_metric_%d' % i, i)
+                  for i in range(self.extra_keys)]
+        return ''.join('%s\t%s\n' % line for line in lines)
+
+    def _summary(self):
+        return (
+            'Latency min/avg/max: 0/1/250\n'
+            'Received: %d\n'
+            'Sent: %d\n'
+            'Connections: %d\n'
+            'Outstanding: 0\n'
+            'Zxid: 0x100000abc\n'
+            'Mode: %s\n'
+            'Node count: 1000\n' % (self.received * 10, self.received * 10,
+                                    self.clients, self.mode))
+
+    def _client_lines(self):
+        return ''.join(
+            ' /10.0.%d.%d:%d[1](queued=0,recved=%d,sent=%d)\n' % (
+                i // 250 % 250, i % 250, 30000 + i % 30000, i, i)
+            for i in range(self.clients))
+
+    def stat(self):
+        return ('Zookeeper version: 3.4.10-39d3a4f, built on 03/23/2017\n'
+                'Clients:\n' + self._client_lines() + '\n' + self._summary())
+
+    def srvr(self):
+        return ('Zookeeper version: 3.4.10-39d3a4f, built on 03/23/2017\n' +
+                self._summary())
+
+    def cons(self):
+        return ''.join(
+            ' /10.0.%d.%d:%d[1](queued=0,recved=%d,sent=%d,sid=0x%x,'
+            'lop=PING,est=1500000000000,to=30000,lcxid=0x%x,lzxid=0x100000abc,'
+            'lresp=1500000000000,llat=0,minlat=0,avglat=0,maxlat=5)\n' % (
+                i // 250 % 250, i % 250, 30000 + i % 30000, i, i,
+                0x1000000 + i, i)
+            for i in range(self.clients)) + '\n'
+
+    def wchs(self):
+        return ('%d connections watching 100 paths\n'
+                'Total watches:200\n' % self.clients)
+
+    def conf(self):
+        return ('clientPort=2181\n'
+                'dataDir=/var/lib/zookeeper/version-2\n'
+                'dataLogDir=/var/lib/zookeeper/version-2\n'
+                'tickTime=2000\n'
+                'maxClientCnxns=50\n'
+                'minSessionTimeout=4000\n'
+                'maxSessionTimeout=40000\n'
+                'serverId=1\n'
+                'initLimit=10\n'
+                'syncLimit=5\n'
+                'electionAlg=3\n'
+                'electionPort=3888\n'
+                'quorumPort=2888\n'
+                'peerType=0\n')
+
+    def srst(self):
+        self.resets += 1
+        return 'Server stats reset.\n'
@@ -0,0 +1,40 @@
+"""
+Unit tests for the charm code, run from the charm directory:
+
+    python3 -m unittest discover -s unit_tests -t .
+
+The charm framework modules (charmhelpers, charms.reactive and the
+libraries of the included layers) only exist in a built charm, so they
+are replaced by mocks; the reactive decorators leave the handlers as they
+are, so that they can be called directly.
+"""
+
+import os
+import sys
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'lib'))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, os.path.join(HERE, '..', 'files'))
+
+
+def _decorator(*args, **kwargs):
+    return lambda func: func
+
+
+reactive = mock.MagicMock()
+for name in ('when', 'when_not', 'when_any', 'when_all', 'hook'):
+    setattr(reactive, name, _decorator)
+
+for name, module in (
+        ('charmhelpers', mock.MagicMock()),
+        ('charmhelpers.core', mock.MagicMock()),
+        ('charmhelpers.core.templating', mock.MagicMock()),
+        ('charms.reactive', reactive),
+        ('charms.reactive.bus', mock.MagicMock()),
+        ('charms.reactive.helpers', mock.MagicMock()),
+        ('charms.reactive.relations', mock.MagicMock()),
+        ('charms.apt', mock.MagicMock()),
+        ('charms.leadership', mock.MagicMock())):
+    sys.modules.setdefault(name, module)
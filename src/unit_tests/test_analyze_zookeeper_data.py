@@ -0,0 +1,179 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import analyze_zookeeper_data as analyzer
+from analyze_zookeeper_data import (
+    INT, LONG, SNAPSHOT_MAGIC, STAT, TXLOG_MAGIC, TXN_HEADER, TxnLogStats,
+    analyze_snapshot)
+
+
+def buffer(data):
+    return INT.pack(len(data)) + data
+
+
+def string(text):
+    return buffer(text.encode('utf-8'))
+
+
+def snapshot(sessions, nodes):
+    '''
+    Encode a snapshot of `sessions`, as (id, timeout) pairs, and of the
+    data tree `nodes`, as (path, data, ephemeral owner) in depth first
+    order, with no ACLs.
+
+    '''
+    data = INT.pack(SNAPSHOT_MAGIC) + INT.pack(2) + LONG.pack(0)
+    data += INT.pack(len(sessions))
+    for session, timeout in sessions:
+        data += LONG.pack(session) + INT.pack(timeout)
+    data += INT.pack(0)
+    for path, content, owner in nodes:
+        data += string(path) + buffer(content) + LONG.pack(-1)
+        data += STAT.pack(1, 1, 0, 0, 0, 0, 0, owner, 1)
+    return data + string('/')
+
+
+def txn(session, zxid, time, kind, body):
+    return TXN_HEADER.pack(session, 1, zxid, time, kind) + body
+
+
+def txlog(txns, padding=64):
+    '''
+    Encode a transaction log of `txns`, each as its payload, or as a
+    (payload, checksum) pair to write a wrong checksum, followed by
+    `padding` zero bytes.
+
+    '''
+    data = INT.pack(TXLOG_MAGIC) + INT.pack(2) + LONG.pack(0)
+    for payload in txns:
+        if isinstance(payload, tuple):
+            payload, crc = payload
+        else:
+            crc = zlib.adler32(payload)
+        data += LONG.pack(crc) + buffer(payload) + bytes([analyzer.EOR])
+    return data + b'\0' * padding
+
+
+def create(path, data):
+    return string(path) + buffer(data) + INT.pack(0) + INT.pack(0)
+
+
+def set_data(path, data):
+    return string(path) + buffer(data) + INT.pack(1)
+
+
+def multi(*ops):
+    return INT.pack(len(ops)) + b''.join(
+        INT.pack(kind) + buffer(body) for kind, body in ops)
+
+
+class AnalyzerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+
+class SnapshotTest(AnalyzerTestCase):
+
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.report = analyze_snapshot(self.write('snapshot.1', snapshot(
+            [(0x100, 30000), (0x200, 10000)],
+            [('', b'', 0),
+             ('/app', b'0123456789', 0),
+             ('/app/a', b'01234', 0),
+             ('/app/a/x', b'012', 0x100),
+             ('/app/b', b'', 0x100),
+             # Left behind by a session that is gone.
+             ('/app/c', b'', 0x300),
+             ('/zookeeper', b'', 0)])))
+
+    def test_totals(self):
+        self.assertEqual((self.report['sessions'], self.report['nodes'],
+                          self.report['data_bytes'],
+                          self.report['ephemerals']), (2, 7, 18, 3))
+        # Paths and data, summed up to the root.
+        self.assertEqual(self.report['approximate_data_size'], 58)
+
+    def test_subtrees(self):
+        self.assertEqual(
+            [(s['path'], s['bytes'], s['nodes'])
+             for s in self.report['largest_subtrees']],
+            [('/app', 48, 5), ('/app/a', 22, 2), ('/app/a/x', 11, 1),
+             ('/zookeeper', 10, 1), ('/app/c', 6, 1), ('/app/b', 6, 1)])
+        self.assertEqual(self.report['largest_nodes'][0],
+                         {'path': '/app', 'data_bytes': 10})
+
+    def test_ephemeral_owners(self):
+        self.assertEqual(self.report['ephemeral_owners'], [
+            {'session': '0x100', 'ephemerals': 2, 'timeout': 30000,
+             'live': True},
+            {'session': '0x300', 'ephemerals': 1, 'timeout': None,
+             'live': False}])
+
+
+class TxnLogTest(AnalyzerTestCase):
+
+    txns = [
+        txn(0x100, 1, 1000, -10, INT.pack(30000)),
+        txn(0x100, 2, 2000, 1, create('/app/a/y', b'0123')),
+        txn(0x200, 3, 2500, 14, multi(
+            (1, create('/app/b/z', b'012')),
+            (2, string('/app/c')),
+            (5, set_data('/app/a', b'0')))),
+        txn(0x100, 4, 3000, 5, set_data('/app/a', b'01')),
+        txn(0x200, 5, 4500, 5, set_data('/app/a/q/r', b'01234')),
+    ]
+
+    def stats(self, *logs):
+        stats = TxnLogStats(depth=2)
+        for i, data in enumerate(logs):
+            stats.add_file(self.write('log.{}'.format(i), data))
+        return stats.report()
+
+    def test_sessions(self):
+        report = self.stats(txlog(self.txns))
+        self.assertEqual((report['txns'], report['seconds'],
+                          report['first_zxid'], report['last_zxid']),
+                         (5, 3.5, '0x1', '0x5'))
+        self.assertEqual(
+            [(s['session'], s['txns'], s['txns_per_second'])
+             for s in report['top_sessions']],
+            [('0x100', 3, 1.5), ('0x200', 2, 1.0)])
+
+    def test_multi(self):
+        report = self.stats(txlog(self.txns))
+        # A multi counts as the operations it holds.
+        self.assertEqual(report['types'], {
+            'createSession': 1, 'create': 2, 'delete': 1, 'setData': 3})
+        self.assertEqual(
+            [(p['path'], p['txns'], p['data_bytes'])
+             for p in report['top_paths']],
+            [('/app/a', 4, 12), ('/app/b', 1, 3), ('/app/c', 1, 0)])
+
+    def test_padding(self):
+        # The zeros preallocated after the last entry end the log.
+        report = self.stats(txlog(self.txns[:2], padding=4096))
+        self.assertEqual(report['files'][0]['txns'], 2)
+
+    def test_bad_checksum(self):
+        # A torn write ends the log, even with entries after it.
+        txns = [self.txns[0], (self.txns[1], 1)] + self.txns[2:]
+        report = self.stats(txlog(txns), txlog(self.txns[3:]))
+        self.assertEqual([f['txns'] for f in report['files']], [1, 2])
+        self.assertEqual(report['txns'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+from reactive import autostart
+
+
+class AutostartTest(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('hookenv', 'is_flag_set', 'Zookeeper'):
+            patcher = mock.patch.object(autostart, name)
+            self.addCleanup(patcher.stop)
+            setattr(self, name, patcher.start())
+        self.is_flag_set.return_value = False
+        self.zookeeper = self.Zookeeper.return_value
+        self.zookeeper.started_in_hook.return_value = False
+
+    def test_serving(self):
+        self.zookeeper.probe.return_value = {'running': True,
+                                             'mode': 'follower'}
+        autostart.autostart_service()
+        self.hookenv.status_set.assert_called_once_with('active', mock.ANY)
+        self.zookeeper.wait_until_ready.assert_not_called()
+
+    def test_not_serving(self):
+        # Another hook: a single probe, no wait.
+        self.zookeeper.probe.return_value = {'running': True, 'mode': None}
+        autostart.autostart_service()
+        self.hookenv.status_set.assert_called_once_with('waiting', mock.ANY)
+        self.zookeeper.wait_until_ready.assert_not_called()
+        self.zookeeper.restart.assert_not_called()
+
+    def test_not_serving_after_start(self):
+        self.zookeeper.started_in_hook.return_value = True
+        self.zookeeper.probe.return_value = {'running': True, 'mode': None}
+        self.zookeeper.wait_until_ready.return_value = {'running': True,
+                                                        'mode': 'leader'}
+        autostart.autostart_service()
+        self.zookeeper.wait_until_ready.assert_called_once_with(
+            autostart.READY_TIMEOUT, progress=mock.ANY)
+        self.hookenv.status_set.assert_called_with('active', mock.ANY)
+        self.zookeeper.restart.assert_not_called()
+
+    def test_down(self):
+        self.zookeeper.probe.return_value = {'running': False, 'mode': None}
+        self.zookeeper.wait_until_ready.return_value = {'running': False,
+                                                        'mode': None}
+        autostart.autostart_service()
+        self.assertEqual(self.zookeeper.restart.call_count,
+                         autostart.RESTART_ATTEMPTS)
+        self.hookenv.status_set.assert_called_with('blocked', mock.ANY)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import check_zookeeper
+
+
+class SampleHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.history = check_zookeeper.SampleHistory(
+            os.path.join(directory, 'history'), capacity=8, columns=4)
+
+    def test_new_key(self):
+        self.history.append(100, {'a': 1})
+        self.history.append(110, {'a': 1, 'b': 50})
+        self.history.append(120, {'a': 1, 'b': 50})
+        summary = self.history.summarize(60, now=120)
+        self.assertEqual(summary['b'], {'min': 50, 'max': 50, 'avg': 50,
+                                        'slope': 0})
+
+    def test_long_key(self):
+        key = 'k' * (check_zookeeper.SampleHistory.NAME_SIZE + 1)
+        for timestamp in (100, 110, 120):
+            self.history.append(timestamp, {key: 1, 'a': timestamp})
+        summary = self.history.summarize(60, now=120)
+        self.assertEqual(list(summary), ['a'])
+        # The long key takes no column: the others still fit.
+        self.history.append(130, {'b': 1, 'c': 2, 'd': 3})
+        self.assertEqual(sorted(self.history.summarize(60, now=130)),
+                         ['a', 'b', 'c', 'd'])
+
+
+class SendCmdLinesTest(unittest.TestCase):
+
+    STAT = (b'Zookeeper version: 3.4.10\n'
+            b'Clients:\n'
+            b' /10.0.0.1:30000[1](queued=0,recved=1,sent=1)\n'
+            b' /10.0.0.2:30001[1](queued=0,recved=2,sent=2)\n'
+            b'\n'
+            b'Latency min/avg/max: 0/1/250\n'
+            b'Mode: follower\n'
+            b'Node count: 1000\n')
+
+    def lines(self, response, size, skip=None):
+        zk = check_zookeeper.ZooKeeperServer(persist=False)
+        zk._recv_chunks = lambda cmd: iter(
+            [response[i:i + size] for i in range(0, len(response), size)])
+        return list(zk._send_cmd_lines('stat', skip=skip))
+
+    def test_lines(self):
+        for size in range(1, len(self.STAT) + 1):
+            self.assertEqual(''.join(self.lines(self.STAT, size)),
+                             self.STAT.decode())
+
+    def test_skip(self):
+        expected = ['Zookeeper version: 3.4.10\n',
+                    'Latency min/avg/max: 0/1/250\n',
+                    'Mode: follower\n', 'Node count: 1000\n']
+        for size in range(1, len(self.STAT) + 1):
+            self.assertEqual(self.lines(self.STAT, size, b'Clients:\n'),
+                             expected)
+
+    def test_skip_empty_block(self):
+        response = b'a: 1\nClients:\n\nMode: leader\n'
+        for size in range(1, len(response) + 1):
+            self.assertEqual(self.lines(response, size, b'Clients:\n'),
+                             ['a: 1\n', 'Mode: leader\n'])
+
+    def test_parse_stat(self):
+        zk = check_zookeeper.ZooKeeperServer(persist=False)
+        zk._recv_chunks = lambda cmd: iter([self.STAT])
+        stats = zk._parse_stat(zk._send_cmd_lines('stat',
+                                                  skip=b'Clients:\n'))
+        self.assertEqual(stats['zk_server_state'], 'follower')
+        self.assertEqual(stats['zk_znode_count'], 1000)
+        self.assertEqual(stats['zk_max_latency'], 250)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from reactive import nagios
+
+
+class RetiredChecksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        patcher = mock.patch.object(nagios, 'CHECK_FILES', (
+            os.path.join(self.directory, 'check_{}.cfg'),
+            os.path.join(self.directory, 'service__*_check_{}.cfg')))
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def touch(self, name):
+        open(os.path.join(self.directory, name), 'w').close()
+
+    def test_setup_removes_retired_checks(self):
+        for name in ('check_zk_avg_latency.cfg',
+                     'service__zookeeper-0_check_zk_avg_latency.cfg',
+                     'check_zk_open_file_descriptor_coun.cfg',
+                     'check_zk_stats.cfg',
+                     'service__zookeeper-0_check_zk_stats.cfg'):
+            self.touch(name)
+        client = mock.Mock()
+        with mock.patch.object(nagios, 'hookenv'), \
+                mock.patch.object(nagios, 'set_state'):
+            nagios.setup_nagios(client)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['check_zk_stats.cfg',
+                          'service__zookeeper-0_check_zk_stats.cfg'])
+        client.updated.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import json
+import unittest
+from unittest import mock
+
+from reactive import zookeeper
+
+
+class RestartBatchesTest(unittest.TestCase):
+
+    peers = ['10.0.0.{}'.format(i) for i in range(1, 8)]
+
+    def test_single_node(self):
+        self.assertEqual(zookeeper._restart_batches(['10.0.0.1'], '10.0.0.1'),
+                         [['10.0.0.1']])
+
+    def test_three_nodes(self):
+        # A node at a time, the leader last.
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers[:3], '10.0.0.1'),
+            [['10.0.0.2'], ['10.0.0.3'], ['10.0.0.1']])
+
+    def test_seven_nodes(self):
+        # Seven voters keep a majority with three of them down.
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers, '10.0.0.7'),
+            [['10.0.0.1', '10.0.0.2', '10.0.0.3'],
+             ['10.0.0.4', '10.0.0.5', '10.0.0.6'],
+             ['10.0.0.7']])
+
+    def test_unknown_leader(self):
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers[:5], None),
+            [['10.0.0.1', '10.0.0.2'], ['10.0.0.3', '10.0.0.4'],
+             ['10.0.0.5']])
+
+    def test_observers_first(self):
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers[:5], '10.0.0.1',
+                                       observers=['10.0.0.4', '10.0.0.5']),
+            [['10.0.0.4', '10.0.0.5'], ['10.0.0.2'], ['10.0.0.3'],
+             ['10.0.0.1']])
+
+    def test_smaller_ensemble(self):
+        # Growing from three voters to seven: the three old ones are
+        # still the quorum until the restart is over.
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers, '10.0.0.7', voters=3),
+            [['10.0.0.{}'.format(i)] for i in range(1, 8)])
+
+    def test_down_nodes(self):
+        # One voter down already: two more may go at a time.
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers, '10.0.0.7',
+                                       down=['10.0.0.2']),
+            [['10.0.0.1', '10.0.0.2'], ['10.0.0.3', '10.0.0.4'],
+             ['10.0.0.5', '10.0.0.6'], ['10.0.0.7']])
+        # Down observers do not count.
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers, '10.0.0.5',
+                                       observers=['10.0.0.6', '10.0.0.7'],
+                                       down=['10.0.0.6']),
+            [['10.0.0.6', '10.0.0.7'], ['10.0.0.1', '10.0.0.2'],
+             ['10.0.0.3', '10.0.0.4'], ['10.0.0.5']])
+
+    def test_no_margin_left(self):
+        # Still one at a time, rather than never restarting.
+        self.assertEqual(
+            zookeeper._restart_batches(self.peers[:3], '10.0.0.1',
+                                       down=['10.0.0.2']),
+            [['10.0.0.2'], ['10.0.0.3'], ['10.0.0.1']])
+
+
+class PatchingTestCase(unittest.TestCase):
+
+    def patch(self, name):
+        patcher = mock.patch.object(zookeeper, name)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+
+class RestartForQuorumTest(PatchingTestCase):
+
+    def setUp(self):
+        self.kv = {}
+        self.leader_data = {
+            'restart_queue': json.dumps([['10.0.0.2'], ['10.0.0.1']]),
+            'restart_nonce': '1.5',
+        }
+        self.hookenv = self.patch('hookenv')
+        self.hookenv.unit_get.return_value = '10.0.0.2'
+        kv = self.patch('unitdata').kv.return_value
+        kv.get.side_effect = self.kv.get
+        kv.set.side_effect = self.kv.__setitem__
+        self.patch('leader_get').side_effect = self.leader_data.get
+        self.leader_set = self.patch('leader_set')
+        self.patch('is_state').return_value = False
+        self.set_flag = self.patch('set_flag')
+        self.restart = self.patch('_restart_zookeeper')
+        self.zkpeer = mock.Mock()
+
+    def test_ready(self):
+        self.restart.return_value = True
+        zookeeper.restart_for_quorum(self.zkpeer)
+        self.zkpeer.inform_restart.assert_called_once_with()
+        self.assertEqual(self.kv['zookeeper.restart_nonce'], '1.5')
+
+    def test_not_ready(self):
+        self.restart.return_value = False
+        zookeeper.restart_for_quorum(self.zkpeer)
+        self.zkpeer.inform_restart.assert_not_called()
+        self.assertNotIn('zookeeper.restart_nonce', self.kv)
+        self.set_flag.assert_called_once_with('zookeeper.restart.pending')
+
+        # No second restart for the same queue...
+        zookeeper.restart_for_quorum(self.zkpeer)
+        self.restart.assert_called_once_with(mock.ANY)
+
+        # ...the restart is reported once the server serves requests.
+        with mock.patch.object(zookeeper, 'Zookeeper') as Zookeeper:
+            Zookeeper.return_value.probe.return_value = {'mode': None}
+            zookeeper.report_restart(self.zkpeer)
+            self.zkpeer.inform_restart.assert_not_called()
+            Zookeeper.return_value.probe.return_value = {'mode': 'follower'}
+            zookeeper.report_restart(self.zkpeer)
+        self.zkpeer.inform_restart.assert_called_once_with()
+        self.assertEqual(self.kv['zookeeper.restart_nonce'], '1.5')
+
+    def test_leader_pops_itself(self):
+        self.hookenv.unit_get.return_value = '10.0.0.1'
+        self.leader_data['restart_queue'] = json.dumps([['10.0.0.1']])
+        zookeeper.is_state.return_value = True
+        self.restart.return_value = True
+        zookeeper.restart_for_quorum(self.zkpeer)
+        self.leader_set.assert_called_once_with(restart_queue='[]')
+
+
+class HoldFirstStartTest(PatchingTestCase):
+
+    def setUp(self):
+        self.config = {'hold_first_start': True}
+        self.flags = set()
+        self.kv = {}
+        self.hookenv = self.patch('hookenv')
+        self.hookenv.config.return_value = self.config
+        self.patch('unitdata').kv.return_value.get.side_effect = self.kv.get
+        self.patch('is_flag_set').side_effect = self.flags.__contains__
+        self.Zookeeper = self.patch('Zookeeper')
+        self.patch('data_changed').return_value = True
+        self.leader_data = {}
+        self.patch('leader_get').side_effect = self.leader_data.get
+        self.patch('apt')
+
+    def install(self):
+        return self.Zookeeper.return_value.install
+
+    def test_held(self):
+        zookeeper.configure()
+        self.install().assert_not_called()
+        self.hookenv.status_set.assert_called_once_with(
+            'blocked', mock.ANY)
+
+    def test_seeded(self):
+        self.kv['zookeeper.seeded'] = True
+        zookeeper.configure()
+        self.install().assert_called_once_with(refresh_tunables=True)
+
+    def test_started(self):
+        self.flags.add('zookeeper.started')
+        zookeeper.configure()
+        self.install().assert_called_once_with(refresh_tunables=True)
+
+    def test_not_held(self):
+        self.config['hold_first_start'] = False
+        zookeeper.configure()
+        self.install().assert_called_once_with(refresh_tunables=True)
+
+    def test_joining(self):
+        # A new unit of a running ensemble waits for its peers.
+        self.config['hold_first_start'] = False
+        self.leader_data['ensemble'] = json.dumps([['0', '10.0.0.1']])
+        zookeeper.configure()
+        self.install().assert_not_called()
+        self.hookenv.status_set.assert_called_once_with('waiting', mock.ANY)
+
+        self.flags.add('zkpeer.joined')
+        zookeeper.configure()
+        self.install().assert_called_once_with(refresh_tunables=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from charms.layer.zookeeper_storage import (
+    EPOCH_FILES, SNAPSHOT_END, VERSION_DIR, create_backup)
+
+
+SEED = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                    'actions', 'seed')
+
+
+class SeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.data_dir = os.path.join(self.tmp, 'data')
+        self.archive = os.path.join(self.tmp, 'backup.tar.gz')
+
+        source = os.path.join(self.tmp, 'source')
+        self.write(source, 'snapshot.500000003', b'new data' + SNAPSHOT_END)
+        self.write(source, 'log.500000001', b'new')
+        create_backup(source, source, self.archive)
+
+        self.params = {'path': self.archive, 'force': False}
+        self.kv = {'zookeeper.storage.data_dir': self.data_dir}
+        core = sys.modules['charmhelpers.core']
+        hookenv = self.patch(core, 'hookenv')
+        hookenv.action_get.side_effect = self.params.get
+        self.action_fail = hookenv.action_fail
+        self.action_set = hookenv.action_set
+        kv = self.patch(core, 'unitdata').kv.return_value
+        kv.get.side_effect = self.kv.get
+        kv.set.side_effect = self.kv.__setitem__
+        self.Zookeeper = mock.patch('charms.layer.zookeeper.Zookeeper').start()
+        self.addCleanup(mock.patch.stopall)
+        self.Zookeeper.return_value.probe.return_value = {'running': True}
+
+    def patch(self, target, name):
+        patcher = mock.patch.object(target, name)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def write(self, data_dir, name, data=b''):
+        directory = os.path.join(data_dir, VERSION_DIR)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+
+    def files(self):
+        return sorted(os.listdir(os.path.join(self.data_dir, VERSION_DIR)))
+
+    def test_empty(self):
+        os.makedirs(self.data_dir)
+        runpy.run_path(SEED)
+        self.action_fail.assert_not_called()
+        self.assertEqual(self.files(),
+                         ['log.500000001', 'snapshot.500000003'])
+        self.assertTrue(self.kv['zookeeper.seeded'])
+
+    def test_existing_data(self):
+        self.write(self.data_dir, 'snapshot.200000002', b'old' + SNAPSHOT_END)
+        runpy.run_path(SEED)
+        self.action_fail.assert_called_once_with(mock.ANY)
+        self.assertEqual(self.files(), ['snapshot.200000002'])
+        self.Zookeeper.return_value.stop.assert_not_called()
+
+    def test_force(self):
+        self.write(self.data_dir, 'snapshot.200000002', b'old' + SNAPSHOT_END)
+        self.write(self.data_dir, 'log.200000001', b'old')
+        for name in EPOCH_FILES:
+            self.write(self.data_dir, name, b'2')
+        with open(os.path.join(self.data_dir, 'myid'), 'w') as f:
+            f.write('3\n')
+        self.params['force'] = True
+
+        runpy.run_path(SEED)
+        self.action_fail.assert_not_called()
+        # The epochs of the old data go with it; myid stays.
+        self.assertEqual(self.files(),
+                         ['log.500000001', 'snapshot.500000003'])
+        with open(os.path.join(self.data_dir, 'myid')) as f:
+            self.assertEqual(f.read(), '3\n')
+        zk = self.Zookeeper.return_value
+        zk.stop.assert_called_once_with()
+        zk.start.assert_called_once_with()
+        self.action_set.assert_called_once_with(
+            {'sha256': mock.ANY, 'files': 'snapshot.500000003 log.500000001'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,245 @@
+import json
+import unittest
+from unittest import mock
+
+from charms.layer import zookeeper
+
+
+class FakeKV(dict):
+
+    def get(self, key, default=None):
+        return super(FakeKV, self).get(key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class PatchingTestCase(unittest.TestCase):
+
+    def patch(self, name, **kwargs):
+        patcher = mock.patch('charms.layer.zookeeper.' + name, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+
+class PurgeTest(PatchingTestCase):
+
+    # Options are strings, as declared in config.yaml.
+    config = {
+        'purge_mode': 'charm',
+        'autopurge_purge_interval': '24',
+        'autopurge_snap_retain_count': '3',
+        'purge_disk_threshold': '80',
+        'purge_retain_hours': '48',
+        'purge_retain_size': '0',
+        'purge_rate': '0',
+    }
+
+    def setUp(self):
+        self.kv = FakeKV({'zookeeper.storage.data_dir': '/data',
+                          zookeeper.PURGE_KEY: 0})
+        self.hookenv = self.patch('hookenv')
+        self.hookenv.config.return_value = self.config
+        self.patch('unitdata').kv.return_value = self.kv
+        self.purge_plan = self.patch('purge_plan', return_value=[])
+        self.disk_usage_percent = self.patch('disk_usage_percent',
+                                             return_value=50.0)
+        self.isdir = self.patch('os.path.isdir', return_value=True)
+
+    def test_keeps_snapshots_for_their_age(self):
+        summary = zookeeper.Zookeeper().purge(force=True)
+        self.purge_plan.assert_called_once_with(
+            '/data', '/data', 3, 48 * 3600, 0)
+        self.assertFalse(summary['pressure'])
+
+    def test_pressure_overrides_age(self):
+        self.kv.set(zookeeper.PURGE_KEY, 2e9)
+        self.disk_usage_percent.return_value = 90.0
+        summary = zookeeper.Zookeeper().purge()
+        self.purge_plan.assert_called_once_with('/data', '/data', 3, 0, 0)
+        self.assertTrue(summary['pressure'])
+
+    def test_not_due(self):
+        self.kv.set(zookeeper.PURGE_KEY, 2e9)
+        self.assertIsNone(zookeeper.Zookeeper().purge())
+        self.purge_plan.assert_not_called()
+
+    def test_no_directory(self):
+        self.isdir.return_value = False
+        self.assertIsNone(zookeeper.Zookeeper().purge(force=True))
+        self.disk_usage_percent.assert_not_called()
+        self.purge_plan.assert_not_called()
+
+    def test_deadline(self):
+        self.purge_plan.return_value = ['/data/version-2/snapshot.1',
+                                        '/data/version-2/snapshot.2']
+        unlink = self.patch('throttled_unlink', return_value=10)
+        exists = self.patch('os.path.exists', return_value=False)
+        summary = zookeeper.Zookeeper().purge(force=True, deadline=1e12)
+        self.assertEqual((summary['files'], summary['freed']),
+                         (['snapshot.1', 'snapshot.2'], 20))
+        self.assertTrue(summary['complete'])
+        self.assertGreater(self.kv[zookeeper.PURGE_KEY], 0)
+
+        # Stopped midway through the first file.
+        self.kv.set(zookeeper.PURGE_KEY, 0)
+        exists.return_value = True
+        summary = zookeeper.Zookeeper().purge(force=True, deadline=1e12)
+        self.assertEqual((summary['files'], summary['freed']), ([], 10))
+        self.assertFalse(summary['complete'])
+        self.assertEqual(self.kv[zookeeper.PURGE_KEY], 0)
+        unlink.assert_called_with('/data/version-2/snapshot.1', 0,
+                                  deadline=1e12)
+
+
+class TunablesTest(PatchingTestCase):
+
+    config = {
+        'tick_time': '2000',
+        'init_limit': 'auto',
+        'sync_limit': '5',
+        'max_client_cnxns': 'auto',
+        'max_participants': '0',
+    }
+
+    def setUp(self):
+        self.kv = FakeKV()
+        self.hookenv = self.patch('hookenv')
+        self.hookenv.config.return_value = self.config
+        self.hookenv.local_unit.return_value = 'zookeeper/0'
+        self.hookenv.relation_ids.return_value = []
+        self.patch('unitdata').kv.return_value = self.kv
+        self.latest_snapshot_size = self.patch('latest_snapshot_size',
+                                               return_value=0)
+        self.clients = 0
+        self.patch('Zookeeper.client_units', side_effect=lambda: self.clients)
+
+    def test_auto_values_are_kept(self):
+        zk = zookeeper.Zookeeper()
+        self.assertEqual(zk.tunables()['max_client_cnxns'], 60)
+        self.assertFalse(zk.auto_tunables_changed())
+
+        # More clients: the server keeps its value until refreshed.
+        self.clients = 10
+        self.assertTrue(zk.auto_tunables_changed())
+        self.assertEqual(zk.tunables()['max_client_cnxns'], 60)
+        self.assertEqual(zk.tunables(refresh=True)['max_client_cnxns'], 120)
+        self.assertEqual(zk.tunables()['max_client_cnxns'], 120)
+        self.assertFalse(zk.auto_tunables_changed())
+
+    def test_init_limit_never_lowered(self):
+        zk = zookeeper.Zookeeper()
+        self.latest_snapshot_size.return_value = 10 * 1024 ** 3
+        high = zk.tunables()['init_limit']
+        self.assertGreater(high, zookeeper.MIN_INIT_LIMIT)
+        self.latest_snapshot_size.return_value = 0
+        self.assertFalse(zk.auto_tunables_changed())
+        self.assertEqual(zk.tunables(refresh=True)['init_limit'], high)
+
+    def test_fixed_values(self):
+        zk = zookeeper.Zookeeper()
+        with mock.patch.dict(self.config, init_limit='15',
+                             max_client_cnxns='0'):
+            tunables = zk.tunables()
+            self.assertFalse(zk.auto_tunables_changed())
+        self.assertEqual((tunables['init_limit'],
+                          tunables['max_client_cnxns']), (15, 0))
+
+
+class HeapTest(PatchingTestCase):
+
+    def setUp(self):
+        self.kv = FakeKV()
+        self.patch('unitdata').kv.return_value = self.kv
+        self.patch('host_memory_mb', return_value=8192)
+        self.data_size = self.patch('Zookeeper.approximate_data_size',
+                                    return_value=None)
+
+    def test_kept_until_refreshed(self):
+        zk = zookeeper.Zookeeper()
+        self.assertEqual(zk.heap_mb(), 4096)
+        self.data_size.return_value = 2048 * 1024 * 1024
+        self.assertEqual(zk.heap_mb(), 4096)
+        self.assertEqual(zk.heap_mb(refresh=True), 6144)
+
+    def test_not_lowered_when_down(self):
+        zk = zookeeper.Zookeeper()
+        self.data_size.return_value = 2048 * 1024 * 1024
+        self.assertEqual(zk.heap_mb(), 6144)
+        self.data_size.return_value = None
+        self.assertEqual(zk.heap_mb(refresh=True), 6144)
+        # A smaller data tree reported by the server does lower it.
+        self.data_size.return_value = 1024
+        self.assertEqual(zk.heap_mb(refresh=True), 4096)
+
+
+class JvmOptionsTest(PatchingTestCase):
+
+    def setUp(self):
+        self.java = self.patch('java_major_version', return_value=8)
+        self.patch('hookenv')
+
+    def options(self, **cfg):
+        return zookeeper.jvm_options(dict({'gc_logging': False}, **cfg),
+                                     heap_mb=1024)
+
+    def test_heap(self):
+        self.assertEqual(self.options()[:2], ['-Xms1024m', '-Xmx1024m'])
+        self.assertEqual(self.options(heap_size='2g')[:2],
+                         ['-Xms2g', '-Xmx2g'])
+        self.assertEqual(self.options(heap_size=''), [])
+
+    def test_cms(self):
+        self.assertIn('-XX:+UseConcMarkSweepGC',
+                      self.options(heap_size='', gc_collector='CMS'))
+        # Java 14 and later have no CMS.
+        self.java.return_value = 17
+        options = self.options(heap_size='', gc_collector='CMS')
+        self.assertNotIn('-XX:+UseConcMarkSweepGC', options)
+        self.assertIn('-XX:+UseG1GC', options)
+
+
+class JoiningEnsembleTest(PatchingTestCase):
+
+    def setUp(self):
+        self.leader_data = {}
+        self.patch('leader_get').side_effect = self.leader_data.get
+        self.patch('Zookeeper.read_peers', return_value=[
+            ('3', '10.0.0.4:2888:3888'), ('0', '10.0.0.1:2888:3888')])
+
+    def test_no_ensemble(self):
+        self.assertEqual(zookeeper.Zookeeper().joining_ensemble(),
+                         [('3', '10.0.0.4:2888:3888'),
+                          ('0', '10.0.0.1:2888:3888')])
+
+    def test_running_ensemble(self):
+        # Only the members of the ensemble, with this node; peers that
+        # are not members yet are added by the leader.
+        self.leader_data['ensemble'] = json.dumps([
+            ['1', '10.0.0.2:2888:3888'], ['2', '10.0.0.3:2888:3888'],
+            ['3', '10.0.0.4:2888:3888:observer']])
+        self.assertEqual(zookeeper.Zookeeper().joining_ensemble(),
+                         [('3', '10.0.0.4:2888:3888'),
+                          ('1', '10.0.0.2:2888:3888'),
+                          ('2', '10.0.0.3:2888:3888')])
+
+
+class PrometheusPortTest(unittest.TestCase):
+
+    def test_disabled(self):
+        for value in (None, '', ' '):
+            self.assertIsNone(zookeeper.prometheus_port(
+                {'prometheus_port': value}))
+
+    def test_valid(self):
+        self.assertEqual(zookeeper.prometheus_port(
+            {'prometheus_port': ' 9141 '}), 9141)
+
+    def test_invalid(self):
+        for value in ('91a1', '0', '-1', '65536'):
+            with self.assertRaises(ValueError):
+                zookeeper.prometheus_port({'prometheus_port': value})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from charms.layer import zookeeper_storage
+from charms.layer.zookeeper_storage import (
+    SNAPSHOT_PREFIX, TXLOG_PREFIX, VERSION_DIR, purge_plan, throttled_unlink)
+
+
+NOW = 1000000
+
+
+class PurgePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        os.mkdir(os.path.join(self.data_dir, VERSION_DIR))
+
+    def add(self, prefix, zxid, size=10, age=0):
+        '''
+        Write a snapshot or log of `size` bytes, last modified `age`
+        seconds before NOW, and return its path.
+
+        '''
+        path = os.path.join(self.data_dir, VERSION_DIR,
+                            '{}{:x}'.format(prefix, zxid))
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        os.utime(path, (NOW - age, NOW - age))
+        return path
+
+    def plan(self, **kwargs):
+        return [os.path.basename(path) for path in
+                purge_plan(self.data_dir, now=NOW, **kwargs)]
+
+    def test_nothing_to_purge(self):
+        self.assertEqual(self.plan(), [])
+        for zxid in (0x10, 0x20, 0x30):
+            self.add(SNAPSHOT_PREFIX, zxid)
+        self.add(TXLOG_PREFIX, 0x1)
+        self.assertEqual(self.plan(retain_count=3), [])
+
+    def test_retain_count(self):
+        for zxid in (0x10, 0x20, 0x30, 0x40, 0x50):
+            self.add(SNAPSHOT_PREFIX, zxid)
+        for zxid in (0x1, 0x15, 0x25, 0x35, 0x45):
+            self.add(TXLOG_PREFIX, zxid)
+        self.assertEqual(self.plan(retain_count=3),
+                         ['snapshot.10', 'snapshot.20', 'log.1', 'log.15'])
+
+    def test_retain_seconds(self):
+        self.add(SNAPSHOT_PREFIX, 0x10, age=5000)
+        self.add(SNAPSHOT_PREFIX, 0x20, age=500)
+        for zxid in (0x30, 0x40, 0x50):
+            self.add(SNAPSHOT_PREFIX, zxid)
+        for zxid in (0x1, 0x15, 0x25):
+            self.add(TXLOG_PREFIX, zxid)
+        self.assertEqual(self.plan(retain_count=3, retain_seconds=1000),
+                         ['snapshot.10', 'log.1'])
+        # Without an age to keep them for, only the newest remain.
+        self.assertEqual(self.plan(retain_count=3, retain_seconds=0),
+                         ['snapshot.10', 'snapshot.20', 'log.1', 'log.15'])
+
+    def test_retain_bytes(self):
+        self.add(SNAPSHOT_PREFIX, 0x10, size=100, age=30)
+        self.add(SNAPSHOT_PREFIX, 0x20, size=100, age=20)
+        for zxid in (0x30, 0x40, 0x50):
+            self.add(SNAPSHOT_PREFIX, zxid, size=100)
+        self.add(TXLOG_PREFIX, 0x1, size=10)
+        self.add(TXLOG_PREFIX, 0x15, size=10)
+        self.add(TXLOG_PREFIX, 0x25, size=10)
+
+        # Everything fits.
+        self.assertEqual(
+            self.plan(retain_count=3, retain_seconds=1000, retain_bytes=600),
+            [])
+        # The oldest extra snapshot goes first, with the logs before it.
+        self.assertEqual(
+            self.plan(retain_count=3, retain_seconds=1000, retain_bytes=500),
+            ['snapshot.10', 'log.1'])
+        # The newest snapshots are kept whatever their size.
+        self.assertEqual(
+            self.plan(retain_count=3, retain_seconds=1000, retain_bytes=1),
+            ['snapshot.10', 'snapshot.20', 'log.1', 'log.15'])
+
+    def test_kept_log_boundary(self):
+        for zxid in (0x10, 0x20, 0x30, 0x40):
+            self.add(SNAPSHOT_PREFIX, zxid)
+        # The log holding the transactions right after the oldest kept
+        # snapshot starts before it, or at its very zxid.
+        self.add(TXLOG_PREFIX, 0x1)
+        self.add(TXLOG_PREFIX, 0x18)
+        self.add(TXLOG_PREFIX, 0x25)
+        self.assertEqual(self.plan(retain_count=3),
+                         ['snapshot.10', 'log.1'])
+        self.add(TXLOG_PREFIX, 0x20)
+        self.assertEqual(self.plan(retain_count=3),
+                         ['snapshot.10', 'log.1', 'log.18'])
+
+    def test_separate_txlog_dir(self):
+        txlog_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, txlog_dir)
+        os.mkdir(os.path.join(txlog_dir, VERSION_DIR))
+        for zxid in (0x10, 0x20, 0x30, 0x40):
+            self.add(SNAPSHOT_PREFIX, zxid)
+        log = os.path.join(txlog_dir, VERSION_DIR, 'log.1')
+        open(log, 'wb').close()
+        self.assertEqual(purge_plan(self.data_dir, txlog_dir, 3, now=NOW),
+                         [os.path.join(self.data_dir, VERSION_DIR,
+                                       'snapshot.10')])
+        open(os.path.join(txlog_dir, VERSION_DIR, 'log.18'), 'wb').close()
+        self.assertEqual(purge_plan(self.data_dir, txlog_dir, 3, now=NOW),
+                         [os.path.join(self.data_dir, VERSION_DIR,
+                                       'snapshot.10'), log])
+
+
+class ThrottledUnlinkTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b'\0' * 1000)
+        os.close(fd)
+        self.addCleanup(lambda: os.path.exists(self.path) and
+                        os.unlink(self.path))
+
+    @mock.patch.object(zookeeper_storage.time, 'sleep')
+    def test_unthrottled(self, sleep):
+        self.assertEqual(throttled_unlink(self.path), 1000)
+        self.assertFalse(os.path.exists(self.path))
+        sleep.assert_not_called()
+
+    @mock.patch.object(zookeeper_storage.time, 'sleep')
+    def test_throttled(self, sleep):
+        sizes = []
+        sleep.side_effect = lambda seconds: sizes.append(
+            os.path.getsize(self.path) if os.path.exists(self.path)
+            else None)
+
+        self.assertEqual(throttled_unlink(self.path, rate=100, step=300), 1000)
+        self.assertFalse(os.path.exists(self.path))
+        # Truncated a step at a time, then unlinked, paced by the rate.
+        self.assertEqual(sizes, [700, 400, 100, None])
+        self.assertAlmostEqual(
+            sum(call[0][0] for call in sleep.call_args_list), 1000 / 100)
+
+    @mock.patch.object(zookeeper_storage.time, 'sleep')
+    @mock.patch.object(zookeeper_storage.time, 'monotonic')
+    def test_deadline(self, monotonic, sleep):
+        clock = [0]
+        monotonic.side_effect = lambda: clock[0]
+        sleep.side_effect = lambda seconds: clock.__setitem__(
+            0, clock[0] + seconds)
+
+        # Two steps of 3 seconds fit before the deadline.
+        self.assertEqual(throttled_unlink(self.path, rate=100, step=300,
+                                          deadline=5), 600)
+        self.assertEqual(os.path.getsize(self.path), 400)
+
+        # The next run finishes it.
+        self.assertEqual(throttled_unlink(self.path, rate=100, step=300,
+                                          deadline=20), 400)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()